@@ -1,12 +1,68 @@
+import time
+startup_start = time.perf_counter()  # Taken before pygame is imported so that importing it is timed too
+
 import pygame
+import functools
+import math
+import mmap
 import os
+import sys
 import random
+import struct
+import atexit
+import gc
+import hashlib
+import json
+
+# NumPy is only needed for --numpy-physics, and importing it takes a while, so it is only imported then
+numpy = None
+if '--numpy-physics' in sys.argv:
+	try:
+		import numpy
+	except ImportError:
+		pass
 
 os.environ['SDL_VIDEO_CENTERED'] = '1'
 
+# What happened while the game started and when, printed with --startup-timeline once the first frame is drawn
+show_startup_timeline = '--startup-timeline' in sys.argv
+startup_timeline = list()  # (what happened, seconds since startup_start)
+started = False  # True once the first frame has been drawn
+
+
+def startup_mark(what):
+	"""
+	Adds something that just happened to startup_timeline, until the first frame is drawn
+	:param what:
+	:return:
+	"""
+	if not started:
+		startup_timeline.append((what, time.perf_counter() - startup_start))
+
+
+def print_startup_timeline():
+	print('Startup timeline (ms since the game started, ms since the last step)')
+	last = 0
+	for what, seconds in startup_timeline:
+		print('{:8.1f} {:+8.1f}  {}'.format(seconds * 1000, (seconds - last) * 1000, what))
+		last = seconds
+
+
+startup_mark('imports')
+
+# In headless mode the game runs without a window, sound or frame rate limit, so levels can be
+# simulated as fast as possible (replays, level checks, bots)
+# The benchmark runs headless too, but still draws every frame so that drawing can be timed
+benchmark = '--benchmark' in sys.argv
+headless = '--headless' in sys.argv or benchmark
+if headless:
+	os.environ['SDL_VIDEODRIVER'] = 'dummy'
+	os.environ['SDL_AUDIODRIVER'] = 'dummy'
+
 pygame.mixer.pre_init(44100, -16, 2, 2048)
 pygame.mixer.init()
 pygame.init()
+startup_mark('pygame.init')
 
 game_exit = False
 
@@ -25,13 +81,63 @@ button_pressed = {'w': False,
                   'p': False,
                   'o': False,
                   'mouse_1': False,
-                  'mouse_2': False}
+                  'mouse_2': False,
+                  'escape': False}  # Only True in the frame ESC was pressed, since it opens and closes menus
 
 is_mouse_visible = True
 tracker_pos = 0
 
+headless_outcome = None  # 'game over', 'level complete' or 'game complete' once a headless run ends
+
+# Replays
+replay_magic = b'DDAR'
+replay_version = 2
+replay_header = '<4sHH'  # Magic, version, physics_rate
+replay_frame = '<IhhB'  # Buttons held, mouse x, mouse y, simulation steps played
+replay_buttons = tuple(button_pressed)  # The order of the bits for the buttons held
+
 starting_screen_shift = [0, 0]  # How much the screen is shifted by originally
 jump_velocity = -65  # Initial jumping velocity
+tile_width = 50  # Every value in Levels.txt is multiplied by this
+
+# Level packs
+level_pack_magic = b'DDAL'
+level_pack_version = 3
+level_pack_header = '<4sHI32s'  # Magic, version, number of levels, SHA-256 of the text file it was compiled from
+level_pack_toc_entry = '<II'  # Where a level starts in the pack and how many bytes it takes, after its name
+
+# Collision groups: the kinds of blocks in level_grid that stop something
+static_solids = frozenset({'wall', 'door', 'no move'})
+dynamic_solids = frozenset({'enemy'})
+move_blockers = static_solids | dynamic_solids  # Stop walking, falling and jumping
+drag_blockers = move_blockers | {'no drag'}  # Where something being dragged can't be
+drag_path_blockers = frozenset({'wall', 'door', 'no drag'})  # What something can't be dragged through
+goal_ground = frozenset({'wall', 'door'})  # What the player has to stand on to complete a level
+ghost_blockers = frozenset({'no move', 'enemy'})  # Where something being dragged leaves its ghost behind
+
+# The other kinds that are looked up in level_grid
+enemy_kinds = frozenset({'enemy'})
+sign_kinds = frozenset({'sign'})
+goal_kinds = frozenset({'goal'})
+door_kinds = frozenset({'door'})
+mob_kinds = frozenset({'enemy', 'goal'})  # What mobs can be, which wake up and set off sensors
+drawn_kinds = frozenset({'goal', 'sign', 'enemy'})  # What is only drawn if it is on the screen
+
+# Simulation
+physics_rate = 120  # Simulation steps per second, no matter how many frames are drawn
+physics_step = 0.1  # How much time passes in the equations of motion in each simulation step
+max_frame_time = 0.25  # The most time simulated after one frame in seconds, so slow frames don't snowball
+render_rate = 120  # The most frames drawn per second
+dirty_rect_rendering = '--dirty-rects' in sys.argv  # Only update the parts of the screen that changed
+chunked_levels = '--chunked-levels' in sys.argv  # Only load the parts of a level near the screen
+numpy_physics = '--numpy-physics' in sys.argv  # Make all the mobs fall at once with NumPy
+previous_screen_shift = [0, 0]  # The screen shift before the last simulation step
+sprite_cache_size = 256  # The most flipped and tinted images kept around to be reused
+text_cache_size = 512  # The most pieces of rendered text kept around to be reused
+font_file = 'Roboto.ttf'  # Used if it is next to the game, instead of looking Roboto up in the system fonts
+font_cache_file = 'Font Path.txt'  # Where Roboto was found in the system fonts, in cache_directory()
+profiler_history = 120  # How many frames the profiler overlay graphs and averages over
+profiler_graph_ms = 50  # The frame time at the top of the profiler graph, in milliseconds
 
 # Colours
 
@@ -62,6 +168,7 @@ resolution = (display_width, display_height)
 Display = pygame.display.set_mode(resolution)
 
 pygame.display.set_caption('Drag Drop Adventure')
+startup_mark('display')
 
 clock = pygame.time.Clock()
 
@@ -70,40 +177,203 @@ small_font_size = display_height // 25
 med_font_size = display_height // 12
 large_font_size = display_height // 5
 
-small_font = pygame.font.SysFont('Roboto', small_font_size)
-med_font = pygame.font.SysFont('Roboto', med_font_size)
-large_font = pygame.font.SysFont('Roboto', large_font_size)
+
+class LazyAssets(dict):
+	"""
+	A dictionary of assets that are each loaded the first time they are used, so that starting the
+	game doesn't wait for assets that aren't needed yet
+	"""
+	def __init__(self, loader, sources):
+		"""
+		:param loader: The function that loads an asset from its source
+		:param sources: name: what the asset is loaded from
+		"""
+		super().__init__()
+		self.loader = loader
+		self.sources = sources
+
+	def __missing__(self, name):
+		asset = self.loader(self.sources[name])
+		self[name] = asset
+		startup_mark('loaded ' + name)
+		return asset
+
+
+def cache_directory():
+	"""
+	:return: The folder for this user where the game keeps what it has worked out between starts,
+	so that nothing is written to the game's own folder
+	"""
+	if os.name == 'nt':
+		base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+	else:
+		base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+	return os.path.join(base, 'Drag Drop Adventure')
+
+
+@functools.lru_cache(maxsize=None)
+def font_path():
+	"""
+	Looking Roboto up in the system fonts can take seconds on systems with lots of fonts, so it is
+	only done if font_file isn't there, and where it was found is kept in font_cache_file for the
+	next start. The cached path is only used while the file is still there. Roboto not being
+	installed isn't kept, so it is found as soon as it is installed
+	:return: The file Roboto is loaded from, or None for pygame's own font if Roboto isn't installed
+	"""
+	if os.path.isfile(font_file):
+		return font_file
+
+	cache_file = os.path.join(cache_directory(), font_cache_file)
+	try:
+		with open(cache_file, 'r') as cache:
+			cached_path = cache.readline().rstrip('\n')
+		if cached_path and os.path.isfile(cached_path):
+			return cached_path
+	except OSError:
+		pass  # Not looked up yet
+
+	path = pygame.font.match_font('Roboto')
+	if path is not None:
+		try:
+			os.makedirs(cache_directory(), exist_ok=True)
+			with open(cache_file, 'w') as cache:
+				cache.write(path + '\n')
+		except OSError:
+			pass  # It is looked up again next time
+	return path
+
+
+def load_font(size):
+	return pygame.font.Font(font_path(), size)
+
+
+fonts = LazyAssets(load_font, {'small': small_font_size,
+                               'medium': med_font_size,
+                               'large': large_font_size})
 
 # Images
-images = {'ground': pygame.image.load('Ground.jpg'),
-          'sensor': pygame.image.load('Sensor.png'),
-          'stationary goal': pygame.image.load('Stationary Goal.png'),
-          'portable goal': pygame.image.load('Portable Goal.png'),
-          'final goal': pygame.image.load('Final Goal.png'),
-          'sign': pygame.image.load('Sign.png'),
-          'star': pygame.image.load('Star.png'),
-          'grey star': pygame.image.load('Grey Star.png'),
-          'lock': pygame.image.load('Lock.png'),
-          'enemy': pygame.image.load('Enemy.png'),
-          'moveable enemy': pygame.image.load('Moveable Enemy.png'),
-          'guard': pygame.image.load('Guard.png'),
-          'spikes': pygame.image.load('Spikes.png'),
-          'boulder': pygame.image.load('Boulder.png'),
-          'player': pygame.image.load('Player.png')}
 
-# Sounds
-sounds = {'boulder crush': pygame.mixer.Sound('Boulder Crush.wav'),
-          'thump': pygame.mixer.Sound('Thump.wav'),
-          'click': pygame.mixer.Sound('Click.wav'),
-          'jump': pygame.mixer.Sound('Jump.wav')}
-
-for sound in sounds:
-	if sound == 'thump':
-		pygame.mixer.Sound.set_volume(sounds[sound], 0.05)
+
+def load_image(file_name):
+	"""
+	Loads an image and converts it to the display's pixel format once, so it doesn't have to be
+	converted every time it is drawn
+	:param file_name:
+	:return:
+	"""
+	image = pygame.image.load(file_name)
+	if file_name.lower().endswith('.jpg'):
+		return image.convert()
+	return image.convert_alpha()
+
+
+images = LazyAssets(load_image, {'ground': 'Ground.jpg',
+                                 'sensor': 'Sensor.png',
+                                 'stationary goal': 'Stationary Goal.png',
+                                 'portable goal': 'Portable Goal.png',
+                                 'final goal': 'Final Goal.png',
+                                 'sign': 'Sign.png',
+                                 'star': 'Star.png',
+                                 'grey star': 'Grey Star.png',
+                                 'lock': 'Lock.png',
+                                 'enemy': 'Enemy.png',
+                                 'moveable enemy': 'Moveable Enemy.png',
+                                 'guard': 'Guard.png',
+                                 'spikes': 'Spikes.png',
+                                 'boulder': 'Boulder.png',
+                                 'player': 'Player.png'})
+
+
+@functools.lru_cache(maxsize=sprite_cache_size)
+def scaled_image(image, size):
+	"""
+	An image scaled to a size, which is shared by everything drawn with the same image at the same
+	size. The returned surface must not be drawn on
+	:param image: The original surface
+	:param size: (width, height)
+	:return:
+	"""
+	return pygame.transform.scale(image, size)
+
+
+@functools.lru_cache(maxsize=sprite_cache_size)
+def sprite_variant(image, flipped=False, tint=None):
+	"""
+	Flipped and tinted versions of an image, which are only made the first time they are needed.
+	The returned surface is shared, so it must not be drawn on
+	:param image: The original surface
+	:param flipped: Whether it is flipped horizontally
+	:param tint: The colour to tint it with. The tinted version is drawn over the original
+	:return:
+	"""
+	if flipped:
+		variant = pygame.transform.flip(image, True, False)
 	else:
-		pygame.mixer.Sound.set_volume(sounds[sound], 0.2)
+		variant = image.copy()
+
+	if tint is not None:
+		# zero out RGB values
+		variant.fill((0, 0, 0, 100), None, pygame.BLEND_RGBA_MULT)
+		# add in new RGB values
+		variant.fill(tuple(tint[0:3]) + (0,), None, pygame.BLEND_RGBA_ADD)
+
+	return variant
+
 
-# Music
+@functools.lru_cache(maxsize=sprite_cache_size)
+def image_mask(image):
+	"""
+	The mask of an image, shared by everything drawn with it
+	:param image:
+	:return:
+	"""
+	return pygame.mask.from_surface(image)
+
+
+@functools.lru_cache(maxsize=sprite_cache_size)
+def see_through_surface(image, size, colour):
+	"""
+	The see through version of an image that ghosts and jump detectors are drawn with, shared
+	by every ghost and detector of the same image. The returned surface must not be drawn on
+	:param image: The original surface, or None for a plain rectangle
+	:param size: (width, height) of the rectangle if there is no image
+	:param colour: Colour of the rectangle if there is no image
+	:return:
+	"""
+	if image is not None:
+		surface = image.convert_alpha()
+	else:
+		surface = pygame.Surface(size)
+	surface.set_alpha(150)
+
+	if image is None:
+		surface.fill(colour)
+	else:
+		surface.fill((255, 255, 255, 128), None, pygame.BLEND_RGBA_MULT)
+
+	return surface
+
+
+# Sounds
+
+
+def load_sound(source):
+	"""
+	:param source: (file name, volume)
+	:return:
+	"""
+	file_name, volume = source
+	sound = pygame.mixer.Sound(file_name)
+	sound.set_volume(volume)
+	return sound
+
+
+sounds = LazyAssets(load_sound, {'boulder crush': ('Boulder Crush.wav', 0.2),
+                                 'thump': ('Thump.wav', 0.05),
+                                 'click': ('Click.wav', 0.2),
+                                 'jump': ('Jump.wav', 0.2)})
+
+# Music, which is streamed from the file when it is played instead of being loaded ahead of time
 music = {'game over': 'Game Over.wav',
          'level complete': 'Success.wav'}
 
@@ -123,6 +393,7 @@ class InputButtonStates:
 
 		self.enter = [False]
 		self.space = [False]
+		self.o = [False]
 
 	def update(self):
 
@@ -135,6 +406,235 @@ class InputButtonStates:
 			setattr(self, attr, value)
 
 
+class InputSource:
+	"""
+	Where the buttons pressed and the mouse position come from. This one reads them from SDL,
+	InputRecorder also writes them to a replay file and InputPlayer plays a replay file back
+	"""
+	def __init__(self):
+		self.last_mouse_position = None  # Where the mouse was the last time mouse_movement was called
+
+	def poll(self, menu=None):
+		"""
+		Updates button_pressed and button_states for a new frame
+		:param menu: The menu that is open, or None while playing
+		:return: True if the menu should close
+		"""
+		return read_sdl_input(menu)
+
+	def mouse_position(self):
+		return pygame.mouse.get_pos()
+
+	def mouse_movement(self):
+		"""
+		Used instead of pygame.mouse.get_rel, and worked out from mouse_position so that it is the same
+		when a replay is played
+		:return: How far the mouse has moved since the last time this was called
+		"""
+		position = self.mouse_position()
+		last_position = self.last_mouse_position or position
+		self.last_mouse_position = position
+		return position[0] - last_position[0], position[1] - last_position[1]
+
+	def steps_to_simulate(self, steps):
+		"""
+		:param steps: How many simulation steps have to be played this frame to keep up with the clock
+		:return: How many simulation steps to play this frame
+		"""
+		return steps
+
+
+class InputRecorder(InputSource):
+	"""
+	Plays from SDL like InputSource and writes every frame to a replay file, so that the exact
+	same game can be played again by InputPlayer
+
+	The file starts with replay_header and then has one replay_frame for every frame: the buttons
+	held down as bits in the order of replay_buttons, the mouse position and how many simulation
+	steps were played in the frame
+	"""
+	def __init__(self, file_name):
+		super().__init__()
+		self.replay_file = open(file_name, 'wb')
+		self.replay_file.write(struct.pack(replay_header, replay_magic, replay_version, physics_rate))
+		self.frame = None  # The frame being played, which is written once the next one starts
+
+		# The game is quit from a few places, so the last frame is written when Python exits
+		atexit.register(self.close)
+
+	def poll(self, menu=None):
+		self._write_frame()
+
+		done = super().poll(menu)
+
+		buttons_held = 0
+		for bit, button in enumerate(replay_buttons):
+			if button_pressed[button]:
+				buttons_held |= 1 << bit
+		mouse_x, mouse_y = self.mouse_position()
+		self.frame = [buttons_held, int(mouse_x), int(mouse_y), 0]
+
+		return done
+
+	def steps_to_simulate(self, steps):
+		if self.frame is not None:
+			self.frame[3] = steps
+		return steps
+
+	def _write_frame(self):
+		if self.frame is not None and not self.replay_file.closed:
+			self.replay_file.write(struct.pack(replay_frame, *self.frame))
+		self.frame = None
+
+	def close(self):
+		self._write_frame()
+		self.replay_file.close()
+
+
+class InputPlayer(InputSource):
+	"""
+	Plays back a replay file written by InputRecorder instead of reading from SDL. The game quits
+	at the end of the replay. The replay has to start from the same save data to play out the same
+
+	The real window can still be closed, and pressing ESC ends the replay early
+	"""
+	def __init__(self, file_name):
+		super().__init__()
+		with open(file_name, 'rb') as replay_file:
+			data = replay_file.read()
+
+		magic, version, rate = struct.unpack_from(replay_header, data, 0)
+		if magic != replay_magic or version != replay_version:
+			raise ValueError('Not a replay this version of the game can play: ' + file_name)
+		if rate != physics_rate:
+			raise ValueError('The replay was recorded with a different physics_rate: ' + file_name)
+
+		self.frames = struct.iter_unpack(replay_frame, data[struct.calcsize(replay_header):])
+		self.position = (0, 0)
+		self.steps = 0
+
+		# Levels completed in the replay are kept here instead of being written to Saved Data.txt
+		self.completed_levels = get_levels('Saved Data.txt')[0]
+
+	def poll(self, menu=None):
+		global game_exit
+
+		for event in pygame.event.get():
+			if event.type == pygame.QUIT:
+				game_exit = True
+				pygame.quit()
+				quit()
+			if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+				self.frames = iter(())
+
+		frame = next(self.frames, None)
+		if frame is None:
+			if headless:
+				print('The replay ended in', current_level)
+			self.steps = 0
+			for button in button_pressed:
+				button_pressed[button] = False
+			button_states.update()
+			game_exit = True
+			return True
+
+		buttons_held, mouse_x, mouse_y, self.steps = frame
+		for bit, button in enumerate(replay_buttons):
+			button_pressed[button] = bool(buttons_held & (1 << bit))
+		self.position = (mouse_x, mouse_y)
+
+		button_states.update()
+		return False
+
+	def mouse_position(self):
+		return self.position
+
+	def steps_to_simulate(self, steps):
+		return self.steps
+
+
+class ScriptedInput(InputSource):
+	"""
+	Plays the same script over and over instead of reading from SDL, for the benchmark: the player
+	walks right, then left, jumping on the way, and is then dragged around in a long loop
+	"""
+	script_length = 600  # The number of frames before the script starts again
+	drag_start = 400  # The frame of the script where the player is clicked on
+	drag_length = 120  # How many frames the mouse is held down while dragging
+	drag_radius = 150  # How far the player is dragged from where they were clicked on
+
+	def __init__(self):
+		super().__init__()
+		self.frame = -1
+		self.position = (0, 0)
+		self.drag_origin = (0, 0)
+
+	def poll(self, menu=None):
+		pygame.event.pump()
+
+		self.frame += 1
+		moment = self.frame % self.script_length
+
+		for button in button_pressed:
+			button_pressed[button] = False
+
+		if moment < self.drag_start // 2:
+			button_pressed['d'] = True
+		elif moment < self.drag_start:
+			button_pressed['a'] = True
+		if moment % 80 < 10:
+			button_pressed['space'] = True
+
+		if moment == self.drag_start:
+			self.drag_origin = (player.x_with_shift + player.width / 2, player.y_with_shift + player.height / 2)
+		if self.drag_start <= moment < self.drag_start + self.drag_length:
+			# Around a circle and back to where the drag started
+			angle = 2 * math.pi * (moment - self.drag_start) / self.drag_length
+			self.position = (int(self.drag_origin[0] + self.drag_radius * math.sin(angle)),
+			                 int(self.drag_origin[1] + self.drag_radius * (1 - math.cos(angle))))
+			button_pressed['mouse_1'] = True
+		else:
+			self.position = (0, 0)
+
+		button_states.update()
+		return False
+
+	def mouse_position(self):
+		return self.position
+
+	def steps_to_simulate(self, steps):
+		return 1
+
+
+class LimitedInput(InputSource):
+	"""
+	Passes on the input from another input source for a number of frames and then lets go of
+	every button, so that a headless run can't be held up forever by a button that is never let
+	go of, such as a drag that never ends
+	"""
+	def __init__(self, source, frames):
+		super().__init__()
+		self.source = source
+		self.frames_left = frames
+
+	def poll(self, menu=None):
+		if self.frames_left <= 0:
+			pygame.event.pump()
+			for button in button_pressed:
+				button_pressed[button] = False
+			button_states.update()
+			return True
+
+		self.frames_left -= 1
+		return self.source.poll(menu)
+
+	def mouse_position(self):
+		return self.source.mouse_position()
+
+	def steps_to_simulate(self, steps):
+		return self.source.steps_to_simulate(steps)
+
+
 class Ability:
 	def __init__(self):
 		self.recharge_from_empty = 0.75  # 1 less than the maximum time it takes for ability to recharge, in seconds
@@ -188,11 +688,275 @@ class CoolDownBar:
 		                                        self.width * self.completion,
 		                                        self.height])
 
+		screen_updater.drew(self, pygame.Rect(self.x - self.outline, self.y - self.outline,
+		                                      self.width + 2 * self.outline, self.height + 2 * self.outline),
+		                    self.completion)
+
+
+class ScreenUpdater:
+	"""
+	Updates the display every frame
+
+	In dirty rect mode, only the parts of the screen where something moved or changed since the
+	last frame are updated. Everything that is drawn tells the screen updater where it was drawn
+	and what it looked like, so anything that moves, changes, appears or disappears gets its old
+	and new areas updated. Anything drawn across the whole screen (menus, overlays) or the screen
+	shift changing updates the whole screen
+	"""
+	def __init__(self, dirty_rects=False):
+		self.dirty_rects = dirty_rects
+		self.update_all = True
+
+		self.rects = list()  # The parts of the screen to update this frame
+		self.drawn = dict()  # thing drawn: (where it was drawn, what it looked like) in the last frame
+		self.drawn_this_frame = set()
+		self.screen_shift = None  # The screen shift the scene was last drawn with
+		self.last_screen_shift = None  # The screen shift the scene was drawn with in the last update
+
+	def mark(self, rect):
+		if self.dirty_rects:
+			self.rects.append(pygame.Rect(rect))
+
+	def drew(self, thing, rect, appearance=None):
+		"""
+		Keeps track of something that was drawn this frame
+		:param thing: What was drawn. Any hashable value that stays the same between frames
+		:param rect: The part of the screen it was drawn on
+		:param appearance: Anything that changes how it looks without moving it
+		:return:
+		"""
+		if not self.dirty_rects:
+			return
+
+		self.drawn_this_frame.add(thing)
+		last_drawn = self.drawn.get(thing)
+		if last_drawn is None or last_drawn != (rect, appearance):
+			if last_drawn is not None:
+				self.rects.append(last_drawn[0])
+			self.rects.append(pygame.Rect(rect))
+			self.drawn[thing] = (pygame.Rect(rect), appearance)
+
+	def drew_scene(self, shift):
+		"""
+		Keeps track of the screen shift the scene was drawn with. Between simulation steps it is
+		part of the way between two steps, so it isn't the same as screen_shift.amount
+		:param shift:
+		:return:
+		"""
+		self.screen_shift = list(shift)
+
+	def update(self):
+		global started
+
+		if profiler.active:
+			profiler.end_frame()
+
+		if not started:
+			startup_mark('first frame')
+			started = True
+			if show_startup_timeline:
+				print_startup_timeline()
+
+		if headless:
+			self.rects = list()
+			return
+
+		if self.dirty_rects:
+			# Anything that wasn't drawn this frame has to be cleared from where it was
+			for thing in list(self.drawn):
+				if thing not in self.drawn_this_frame:
+					self.rects.append(self.drawn.pop(thing)[0])
+			self.drawn_this_frame = set()
+
+			if self.screen_shift != self.last_screen_shift:
+				self.update_all = True
+				self.last_screen_shift = self.screen_shift
+
+		if (not self.dirty_rects) or self.update_all:
+			pygame.display.update()
+		elif self.rects:
+			pygame.display.update(self.rects)
+
+		self.rects = list()
+		self.update_all = False
+
+
+class Profiler:
+	"""
+	Times parts of the game every frame, for finding out what makes frames slow without an external
+	profiler. Pressing o shows an overlay with the times and a graph of the last frames next to the
+	drag bar, and --profile-log FILE writes the same numbers for every frame as a line of JSON
+
+	The functions decorated with profiled are timed. Each one only counts the time spent in
+	itself and not in other profiled functions it calls, so the times add up to the frame time.
+	A frame ends whenever the screen is updated, so a drag or a menu is many frames, and a function
+	that is still running when a frame ends has the time it took in that frame counted in it
+
+	The benchmark also uses it, with the total times of the functions including the ones they call
+	"""
+	def __init__(self, log_file_name=None):
+		self.show_overlay = False
+		self.log_file = open(log_file_name, 'w') if log_file_name is not None else None
+		if self.log_file is not None:
+			atexit.register(self.log_file.close)
+
+		self.running = list()  # [name, start time in this frame, time spent in profiled functions it called]
+		self.times = dict()  # name: seconds spent in it this frame
+		self.total_times = dict()  # name: seconds spent in it and the profiled functions it called this frame
+		self.recorded_frames = None  # (frame time, total_times) of every frame, while the benchmark records them
+		self.collision_checks = 0  # Rects, paths and masks checked against each other this frame
+		self.frame_start = None
+		self.frame_number = 0
+		self.allocated_blocks = sys.getallocatedblocks()
+		self.gc_collections = self._gc_collections()
+
+		self.history = list()  # (frame time, times, collision checks, new blocks, collections) of the last frames
+		self.summary = list()  # The lines of text on the overlay, which only change every profiler_history frames
+
+	@property
+	def active(self):
+		return self.show_overlay or self.log_file is not None or self.recorded_frames is not None
+
+	def toggle_overlay(self):
+		self.show_overlay = not self.show_overlay
+		if self.log_file is None:
+			# Nothing was timed while the overlay was hidden
+			self.frame_start = None
+			self.history = list()
+			self.summary = list()
+
+	def start(self, name):
+		self.running.append([name, time.perf_counter(), 0])
+
+	def stop(self):
+		now = time.perf_counter()
+		running = self.running.pop()
+		self._count(running, now)
+		if self.running:
+			self.running[-1][2] += now - running[1]
+
+	def _count(self, running, now):
+		name, start, in_others = running
+		self.times[name] = self.times.get(name, 0) + now - start - in_others
+		self.total_times[name] = self.total_times.get(name, 0) + now - start
+
+	def skip_frame(self):
+		"""
+		Starts a new frame without keeping the one that was going on, e.g. after a level is loaded
+		:return:
+		"""
+		self.frame_start = time.perf_counter()
+		self.times = dict()
+		self.total_times = dict()
+		self.collision_checks = 0
+
+	def end_frame(self):
+		"""
+		Records everything timed and counted since the last frame ended, then logs it and draws the overlay
+		:return:
+		"""
+		now = time.perf_counter()
+		allocated_blocks = sys.getallocatedblocks()
+		gc_collections = self._gc_collections()
+
+		# The functions still running count the time they took in this frame, innermost first
+		for depth in range(len(self.running) - 1, -1, -1):
+			running = self.running[depth]
+			self._count(running, now)
+			if depth > 0:
+				self.running[depth - 1][2] += now - running[1]
+			running[1] = now
+			running[2] = 0
+
+		if self.frame_start is not None:
+			frame = (now - self.frame_start, self.times, self.collision_checks,
+			         allocated_blocks - self.allocated_blocks, gc_collections - self.gc_collections)
+			self.history.append(frame)
+			if len(self.history) > profiler_history:
+				del self.history[0]
+			if self.frame_number % profiler_history == 0 or not self.summary:
+				self.summary = self._summarise()
+
+			if self.log_file is not None:
+				self._log(frame)
+			if self.recorded_frames is not None:
+				self.recorded_frames.append((frame[0], self.total_times))
+
+			if self.show_overlay and not headless:
+				self.draw()
+
+		self.frame_start = now
+		self.frame_number += 1
+		self.times = dict()
+		self.total_times = dict()
+		self.collision_checks = 0
+		self.allocated_blocks = allocated_blocks
+		self.gc_collections = gc_collections
+
+	def draw(self):
+		line_height = fonts['small'].get_linesize()
+		panel = pygame.Rect(5, 5, 260, line_height * len(self.summary) + 10)
+		pygame.draw.rect(Display, white, panel)
+		pygame.draw.rect(Display, black, panel, 1)
+		for line_number, line in enumerate(self.summary):
+			# The numbers change too often for rendered_text to be worth caching them
+			Display.blit(fonts['small'].render(line, True, black), (panel.x + 5, panel.y + 5 + line_number * line_height))
+
+		# The graph of the last frames, next to the drag bar
+		graph = pygame.Rect(drag_bar.x + drag_bar.width + 20, drag_bar.y, profiler_history, drag_bar.height)
+		pygame.draw.rect(Display, white, graph)
+		for x, (frame_time, *_) in enumerate(self.history):
+			height = min(frame_time * 1000 / profiler_graph_ms, 1) * graph.height
+			colour = green if frame_time <= 1 / 60 else red
+			pygame.draw.line(Display, colour, (graph.x + x, graph.bottom - 1), (graph.x + x, graph.bottom - height))
+		budget_y = graph.bottom - 1000 / 60 / profiler_graph_ms * graph.height
+		pygame.draw.line(Display, grey, (graph.x, budget_y), (graph.right - 1, budget_y))
+		pygame.draw.rect(Display, black, graph, 1)
+
+		screen_updater.drew(self, panel.union(graph), self.frame_number)
+
+	def _summarise(self):
+		frames = len(self.history)
+		frame_times = sorted(frame[0] for frame in self.history)
+		section_times = dict()
+		for _, times, *_ in self.history:
+			for name, seconds in times.items():
+				section_times[name] = section_times.get(name, 0) + seconds
+
+		lines = ['frame {:.2f} ms, p99 {:.2f} ms'.format(sum(frame_times) / frames * 1000,
+		                                                  percentile(frame_times, 0.99) * 1000)]
+		for name, seconds in sorted(section_times.items(), key=lambda item: -item[1]):
+			lines.append('{} {:.3f} ms'.format(name, seconds / frames * 1000))
+		lines.append('collision checks {:.0f}'.format(sum(frame[2] for frame in self.history) / frames))
+		lines.append('new blocks {:+.0f}'.format(sum(frame[3] for frame in self.history) / frames))
+		lines.append('gc collections {}'.format(sum(frame[4] for frame in self.history)))
+		return lines
+
+	def _log(self, frame):
+		frame_time, times, collision_checks, new_blocks, collections = frame
+		self.log_file.write(json.dumps({'frame': self.frame_number,
+		                                'frame_ms': frame_time * 1000,
+		                                'ms': {name: seconds * 1000 for name, seconds in times.items()},
+		                                'collision_checks': collision_checks,
+		                                'new_blocks': new_blocks,
+		                                'gc_collections': collections}) + '\n')
+
+	@staticmethod
+	def _gc_collections():
+		return sum(generation['collections'] for generation in gc.get_stats())
+
 
 class Character:
+	__slots__ = ('x_range', 'original_x', 'original_y', '_x', '_y', 'width', 'height', 'rect',
+	             'velocity', 'original_facing', 'facing', 'colour', 'img', 'mask', 'tint',
+	             'last_eligible_pos', 'visible', 'can_drag', 'can_move', 'can_fall',
+	             '_ghost', '_collision_detector', '_jump_detector')
+
 	def __init__(self, x=display_width / 2,
 	             y=display_height / 2,
-	             width=30, height=48, img=images['player']):
+	             width=30, height=48, img=None):
+		if img is None:
+			img = images['player']
 		self.x_range = (100, display_width - 100 - width)
 		self.original_x = x - width
 		self.original_y = y
@@ -209,24 +973,16 @@ class Character:
 
 		self.colour = green
 		self.img = img
-		self.mask = pygame.mask.from_surface(self.img)
+		self.mask = image_mask(self.img)
 		self.tint = None
 
 		self.last_eligible_pos = None
 		self.visible = True
 
-		if type(self).__name__ not in {'GhostCharacter', 'CollisionDetector', 'JumpDetector'}:
-			self.ghost = GhostCharacter(self.x, self.y,
-			                            self.width, self.height,
-			                            self.img, self)
-		if type(self).__name__ not in {'GhostCharacter', 'CollisionDetector', 'JumpDetector'}:
-			self.collision_detector = CollisionDetector(self.x, self.y,
-			                                            self.width, self.height,
-			                                            self.img)
-		if type(self).__name__ not in {'GhostCharacter', 'CollisionDetector', 'JumpDetector'}:
-			self.jump_detector = JumpDetector(self.x, self.y + 1,
-			                                  self.width, self.height,
-			                                  self.img, self)
+		# The ghost and detectors are only made the first time they are used
+		self._ghost = None
+		self._collision_detector = None
+		self._jump_detector = None
 
 		self.update_rect()
 
@@ -234,6 +990,35 @@ class Character:
 		self.can_move = True
 		self.can_fall = True
 
+	@property
+	def ghost(self):
+		if self._ghost is None:
+			self._ghost = GhostCharacter(self.x, self.y,
+			                             self.width, self.height,
+			                             self.img, self)
+		return self._ghost
+
+	@property
+	def collision_detector(self):
+		if self._collision_detector is None:
+			self._collision_detector = CollisionDetector(self.x, self.y,
+			                                             self.width, self.height,
+			                                             self.img)
+		return self._collision_detector
+
+	@property
+	def jump_detector(self):
+		if self._jump_detector is None:
+			self._jump_detector = JumpDetector(self.x, self.y + 1,
+			                                   self.width, self.height,
+			                                   self.img, self)
+		return self._jump_detector
+
+	def draw_ghost(self):
+		# A character that has never been dragged has no ghost to draw
+		if self._ghost is not None:
+			self._ghost.draw()
+
 	@property
 	def x_with_shift(self):
 		return self.x
@@ -273,33 +1058,23 @@ class Character:
 		self.update_rect()
 
 	def draw(self):
-		self.update_rect()
-		if self.img is not None:
-			if self.facing != self.original_facing:
-				img = pygame.transform.flip(self.img, True, False)
-			else:
-				img = self.img
-
 		if self.visible:
 			if self.img is None:
-				pygame.draw.rect(Display, self.colour, self.rect)
+				pygame.draw.rect(Display, self.colour, (self.x_with_shift, self.y_with_shift, self.width, self.height))
 			else:
+				if self.facing != self.original_facing:
+					img = sprite_variant(self.img, True)
+				else:
+					img = self.img
 				Display.blit(img, (self.x_with_shift, self.y_with_shift))
 				if self.tint is not None:
 					Display.blit(self.colourize(self.tint, self.facing), (self.x_with_shift, self.y_with_shift))
 
-	def colourize(self, colour, direction):
-		if direction != self.original_facing:
-			image = pygame.transform.flip(self.img, True, False)
-		else:
-			image = self.img.copy()
+			screen_updater.drew(self, pygame.Rect(self.x_with_shift, self.y_with_shift, self.width, self.height),
+			                    (self.facing, self.tint))
 
-		# zero out RGB values
-		image.fill((0, 0, 0, 100), None, pygame.BLEND_RGBA_MULT)
-		# add in new RGB values
-		image.fill(colour[0:3] + (0,), None, pygame.BLEND_RGBA_ADD)
-
-		return image
+	def colourize(self, colour, direction):
+		return sprite_variant(self.img, direction != self.original_facing, tuple(colour))
 
 	def follow(self, original_mouse_pos, mouse_pos):
 		loc_rel_chr = original_mouse_pos[0] - self.original_x, original_mouse_pos[1] - self.original_y
@@ -309,84 +1084,99 @@ class Character:
 	def update_rect(self):
 		self.rect = pygame.Rect(self.x, self.y, self.width, self.height)
 
+	def world_rect(self):
+		"""
+		The rect of the character in level coordinates, which is what level_grid uses.
+		The screen shift is floored so that it lines up with the blocks the same way
+		as when both rects are on the screen
+		:return:
+		"""
+		return pygame.Rect(int(self.x_with_shift) - math.floor(screen_shift.x),
+		                   int(self.y_with_shift) - math.floor(screen_shift.y),
+		                   self.width, self.height)
+
 
 class GhostCharacter(Character):
+	__slots__ = ('character',)
+
 	def __init__(self, x=display_width / 2,
 	             y=display_height / 2,
 	             width=30,
-	             height=48, img=images['player'], character=None):
+	             height=48, img=None, character=None):
 		super().__init__(x=x, y=y, width=width, height=height, img=img)
 
 		self.visible = False
 
 		self.character = character
 
-		if self.img is not None:
-			self.surface = self.img.convert_alpha()
-		else:
-			self.surface = pygame.Surface((self.width, self.height))
-		self.surface.set_alpha(150)
-
-		if self.img is None:
-			self.surface.fill(self.colour)
-		else:
-			self.surface.fill((255, 255, 255, 128), None, pygame.BLEND_RGBA_MULT)
+	@property
+	def surface(self):
+		return see_through_surface(self.img, (self.width, self.height), self.colour)
 
 	def draw(self):
-		if self.character.facing != self.character.original_facing:
-			surface = pygame.transform.flip(self.surface, True, False)
-		else:
-			surface = self.surface
 		if self.visible:
+			if self.character.facing != self.character.original_facing:
+				surface = sprite_variant(self.surface, True)
+			else:
+				surface = self.surface
 			Display.blit(surface, (self.x, self.y))
+			screen_updater.drew(self, pygame.Rect(self.x, self.y, self.width, self.height), self.character.facing)
 
 
 class CollisionDetector(Character):
+	__slots__ = ('did_collide',)
+
 	def __init__(self,
 	             x=display_width / 2, y=display_height / 2,
-	             width=30, height=48, img=images['player']):
+	             width=30, height=48, img=None):
 		super().__init__(x=x, y=y, width=width, height=height, img=img)
 		self.did_collide = False  # True if it collided with something in the previous check
 		self.colour = blue
 
 
 class JumpDetector(CollisionDetector):
+	__slots__ = ('character',)
+
 	def __init__(self, x=display_width / 2,
 	             y=display_height / 2,
 	             width=30, height=48,
-	             img=images['player'], character=None):
+	             img=None, character=None):
 		super().__init__(x, y,
 		                 width, height,
 		                 img)
 
 		self.character = character
 
-		if self.img is not None:
-			self.surface = self.img.convert_alpha()
-		else:
-			self.surface = pygame.Surface((self.width, self.height))
-		self.surface.set_alpha(150)
-
-		if self.img is None:
-			self.surface.fill(grey)
-		else:
-			self.surface.fill((255, 255, 255, 128), None, pygame.BLEND_RGBA_MULT)
+	@property
+	def surface(self):
+		return see_through_surface(self.img, (self.width, self.height), grey)
 
 	def draw(self):
 		Display.blit(self.surface, (self.x, self.y))
 
-	def can_jump(self, blocks):
+	def can_jump(self, kinds, exclude=None):
 		if self.character is not None:
 			self.x = self.character.x_with_shift
 			self.y = self.character.y_with_shift + 1
-			if self.rect.collidelist(blocks) != -1:
+			if level_grid.first(self.character.world_rect().move(0, 1), kinds, exclude) is not None:
 				return True
 			else:
 				return False
 		else:
 			return None
 
-	def might_fall(self, blocks):
+	def blocks_below(self, kinds, exclude=None):
+		"""
+		:return: Every block of the given kinds directly under the character
+		"""
+		if self.character is not None:
+			self.x = self.character.x_with_shift
+			self.y = self.character.y_with_shift + 1
+			return level_grid.query(self.character.world_rect().move(0, 1), kinds, exclude)
+		else:
+			return list()
+
+	def might_fall(self, kinds, exclude=None):
 		if hasattr(self.character, 'to_move'):
 			if self.character.to_move < 0:
 				direction = -1
@@ -400,7 +1190,8 @@ class JumpDetector(CollisionDetector):
 			self.x += self.character.width * direction
 			self.y += 1
 
-			if self.rect.collidelist(blocks) != -1:
+			if level_grid.first(self.character.world_rect().move(self.character.width * direction, 1),
+			                    kinds, exclude) is not None:
 				return False
 			else:
 				return True
@@ -409,14 +1200,17 @@ class JumpDetector(CollisionDetector):
 
 
 class Mob(Character):
+	__slots__ = ('name', 'to_move', 'awake', 'previous_x', 'previous_y')
+
 	def __init__(self, x=display_width / 2,
 	             y=display_height / 2,
 	             width=30, height=48,
-	             img=images['enemy'],
+	             img=None,
 	             name=None,
 	             can_drag=True, can_move=True, can_fall=True):
+		if img is None:
+			img = images['enemy']
 		super().__init__(x + width, y, img.get_rect().width, img.get_rect().height, img)
-		self.mask = pygame.mask.from_surface(self.img)
 		# self.width = img.get_rect().width
 		# self.height = img.get_rect().height
 
@@ -427,6 +1221,13 @@ class Mob(Character):
 
 		self.to_move = 1
 
+		# Asleep mobs are resting and aren't moved until something near them changes
+		self.awake = True
+
+		# Where the mob was before the last simulation step
+		self.previous_x = self.x
+		self.previous_y = self.y
+
 	@property
 	def x_with_shift(self):
 		return self.x + screen_shift.x
@@ -464,30 +1265,41 @@ class Mob(Character):
 		self.update_rect()
 
 	def update_rect(self):
-		self.rect = pygame.Rect(self.x_with_shift,
-		                        self.y_with_shift,
-		                        self.width, self.height)
+		# Unlike the player, a mob's rect is kept in level coordinates so it
+		# doesn't have to be rebuilt whenever the screen shifts
+		self.rect = pygame.Rect(self.x, self.y, self.width, self.height)
+		if self in level_grid:
+			level_grid.move(self, self.rect)
+
+	def world_rect(self):
+		return self.rect.copy()
 
 
 class Boulder(Mob):
+	__slots__ = ()
+
 	def __init__(self, x=display_width / 2,
 	             y=display_height / 2,
 	             width=30, height=48,
-	             img=images['enemy'],
+	             img=None,
 	             name=None,
 	             can_drag=True, can_move=True, can_fall=True):
 		super().__init__(x, y, width, height, img, name, can_drag, can_move, can_fall)
 
 
 class Block:
-	def __init__(self, x=0, y=0, width=50, height=50, texture=images['ground']):
+	__slots__ = ('_x', '_y', 'width', 'height', 'rect', 'texture', 'tint', 'final')
+
+	def __init__(self, x=0, y=0, width=50, height=50, texture=None):
+		if texture is None:
+			texture = images['ground']
 		self._x = x
 		self._y = y
 		self.width = int(width)
 		self.height = int(height)
-		self.rect = pygame.Rect(screen_shift.x + self.x, screen_shift.y + self.y, self.width, self.height)
+		self.rect = pygame.Rect(self.x, self.y, self.width, self.height)  # In level coordinates
 		if not isinstance(texture, tuple):
-			self.texture = pygame.transform.scale(texture, (self.width, self.height))
+			self.texture = scaled_image(texture, (self.width, self.height))
 		else:
 			self.texture = texture
 
@@ -502,7 +1314,7 @@ class Block:
 	@x.setter
 	def x(self, value):
 		self._x = value
-		self.rect = pygame.Rect(screen_shift.x + self._x, screen_shift.y + self.y, self.width, self.height)
+		self.rect.x = value
 
 	@property
 	def y(self):
@@ -511,40 +1323,39 @@ class Block:
 	@y.setter
 	def y(self, value):
 		self._y = value
-		self.rect = pygame.Rect(screen_shift.x + self.x, screen_shift.y + self._y, self.width, self.height)
-
-	def update_rect(self):
-		self.rect = pygame.Rect(screen_shift.x + self.x, screen_shift.y + self.y, self.width, self.height)
+		self.rect.y = value
 
 	def draw(self):
-		self.update_rect()
+		# The screen shift is only added on when drawing
+		self.draw_onto(Display, screen_shift.x + self.x, screen_shift.y + self.y)
+		screen_updater.drew(self, pygame.Rect(screen_shift.x + self.x, screen_shift.y + self.y,
+		                                      self.width, self.height),
+		                    (self.texture, self.tint))
 
+	def draw_onto(self, surface, x, y):
 		if isinstance(self.texture, tuple):
-			pygame.draw.rect(Display, self.texture, self.rect)
+			pygame.draw.rect(surface, self.texture, (x, y, self.width, self.height))
 		elif self.texture.__class__.__name__ == 'Surface':
-			Display.blit(self.texture, self.rect)
+			surface.blit(self.texture, (x, y))
 			if self.tint is not None:
-				Display.blit(self.colourize(self.tint), self.rect)
+				surface.blit(self.colourize(self.tint), (x, y))
 
 	def colourize(self, colour):
-		image = self.texture.copy()
-
-		# zero out RGB values
-		image.fill((0, 0, 0, 100), None, pygame.BLEND_RGBA_MULT)
-		# add in new RGB values
-		image.fill(colour[0:3] + (0,), None, pygame.BLEND_RGBA_ADD)
-
-		return image
+		return sprite_variant(self.texture, False, tuple(colour))
 
 
 class Sign(Mob):
+	__slots__ = ('msg', 'text_box_x', 'text_box_y', 'text_box_width', 'text_box_height', 'line_height', 'activated')
+
 	def __init__(self, msg='',
 	             x=display_width / 2,
 	             y=display_height / 2,
 	             width=50, height=50,
-	             img=images['sign'],
+	             img=None,
 	             name=None,
 	             can_drag=False, can_move=False, can_fall=False):
+		if img is None:
+			img = images['sign']
 		super().__init__(x, y, width, height, img, name, can_drag, can_move, can_fall)
 
 		self.msg = msg
@@ -553,54 +1364,21 @@ class Sign(Mob):
 		self.text_box_width = 300
 		self.text_box_height = 0
 
-		_, self.text_rect = text_object(msg, black, 'small')
-		self.msg = self._keep_splitting(msg)
+		# Measured instead of rendered, since only the height of the message is needed
+		self.line_height = fonts['small'].size(msg)[1]
+		self.msg = list(wrap_text(msg, self.text_box_width, 'small'))
 
 		self.activated = False
 
-	def _split_message(self, msg):
-		_, text_rect = text_object(msg, black, 'small')
-		if text_rect.width >= self.text_box_width:
-			msg = msg[:-1]
-			msg = self._split_message(msg)
-
-		return msg
-
-	def _keep_splitting(self, msg):
-		list_of_msgs = list()
-		part_of_msg = self._split_message(msg)
-		next_part_of_msg = msg[len(part_of_msg):]
-
-		part_of_msg, next_part_of_msg = self._space_in_message(part_of_msg, next_part_of_msg, msg)
-
-		_, next_part_of_msg_rect = text_object(next_part_of_msg, black, 'small')
-
-		list_of_msgs.append(part_of_msg)
-		if next_part_of_msg_rect.width >= self.text_box_width:
-			list_of_msgs += self._keep_splitting(next_part_of_msg)
-
-		else:
-			list_of_msgs.append(next_part_of_msg)
-
-		return list_of_msgs
-
-	def _space_in_message(self, part_of_msg, next_part_of_msg, msg):
-		if part_of_msg[-1] != ' ':
-			if next_part_of_msg != '':
-				if next_part_of_msg[0] != ' ':
-					part_of_msg = part_of_msg[:-1]
-					next_part_of_msg = msg[len(part_of_msg):]
-					if part_of_msg != '':
-						part_of_msg, next_part_of_msg = self._space_in_message(part_of_msg, next_part_of_msg, msg)
-				else:
-					next_part_of_msg = next_part_of_msg[1:]
-		return part_of_msg, next_part_of_msg
-
 	def sign_output(self):
 		pygame.draw.rect(Display, black, [self.text_box_x - 1, self.text_box_y - 1,
 		                                  self.text_box_width + 2, self.text_box_height + 2])
 		pygame.draw.rect(Display, grey, [self.text_box_x, self.text_box_y,
 		                                 self.text_box_width, self.text_box_height])
+		screen_updater.drew((self, 'text box'),
+		                    pygame.Rect(self.text_box_x - 1, self.text_box_y - 1,
+		                                self.text_box_width + 2, self.text_box_height + 2),
+		                    self.text_box_height)
 		self._display_message()
 
 	def _display_message(self):
@@ -613,14 +1391,607 @@ class Sign(Mob):
 			                  y_displace=self.text_box_y + 1 + y_value_of_msg,
 			                  side='custom_top_left')
 
-			y_value_of_msg += self.text_rect.height
+			y_value_of_msg += self.line_height
 
 		if y_value_of_msg > self.text_box_height:
 			self.text_box_height = y_value_of_msg
 			self.sign_output()
 
 
+class SpatialGrid:
+	"""
+	A uniform grid of the rects in the level, in level coordinates (without the screen shift)
+
+	Every item is stored with the kind of block it is ('wall', 'door', 'enemy' etc.) so that
+	each query only looks at the nearby blocks of the kinds it collides with
+	"""
+	def __init__(self, cell_size=tile_width):
+		self.cell_size = cell_size
+		# (column, row): the items overlapping that cell. They are the keys of a dictionary instead of a set
+		# so that queries find them in the order they were added, not in an order that changes between runs
+		self.cells = dict()
+		self.items = dict()  # item: [rect, kind, list of cells the item is in]
+
+	def __contains__(self, item):
+		return item in self.items
+
+	def clear(self):
+		self.cells = dict()
+		self.items = dict()
+
+	def _cells_for(self, rect):
+		first_column = int(rect.left // self.cell_size)
+		last_column = int((rect.right - 1) // self.cell_size)
+		first_row = int(rect.top // self.cell_size)
+		last_row = int((rect.bottom - 1) // self.cell_size)
+
+		return [(column, row)
+		        for column in range(first_column, last_column + 1)
+		        for row in range(first_row, last_row + 1)]
+
+	def insert(self, item, rect, kind):
+		rect = pygame.Rect(rect)
+		cells = self._cells_for(rect)
+		for cell in cells:
+			self.cells.setdefault(cell, dict())[item] = None
+		self.items[item] = [rect, kind, cells]
+
+	def remove(self, item):
+		if item in self.items:
+			_, _, cells = self.items.pop(item)
+			for cell in cells:
+				self.cells[cell].pop(item, None)
+				if not self.cells[cell]:
+					del self.cells[cell]
+
+	def move(self, item, rect):
+		"""
+		Updates the rect of an item that is already in the grid
+		:param item: The item that moved
+		:param rect: The new rect of the item in level coordinates
+		:return:
+		"""
+		entry = self.items.get(item)
+		if entry is None:
+			return
+
+		rect = pygame.Rect(rect)
+		cells = self._cells_for(rect)
+		if cells != entry[2]:
+			for cell in entry[2]:
+				self.cells[cell].pop(item, None)
+				if not self.cells[cell]:
+					del self.cells[cell]
+			for cell in cells:
+				self.cells.setdefault(cell, dict())[item] = None
+			entry[2] = cells
+		entry[0] = rect
+
+	def rect_of(self, item):
+		return self.items[item][0]
+
+	def query(self, rect, kinds, exclude=None):
+		"""
+		Finds every item of the given kinds that collides with rect
+		:param rect: rect in level coordinates
+		:param kinds: the kinds of items that are checked
+		:param exclude: an item that is never returned, usually the character doing the check
+		:return: list of the colliding items
+		"""
+		found = list()
+		seen = set()
+		for cell in self._cells_for(rect):
+			for item in self.cells.get(cell, ()):
+				if item in seen or item is exclude:
+					continue
+				seen.add(item)
+
+				item_rect, kind, _ = self.items[item]
+				if kind in kinds and item_rect.colliderect(rect):
+					found.append(item)
+		profiler.collision_checks += len(seen)
+		return found
+
+	def sweep(self, rect, axis, direction, distance, kinds, exclude=None):
+		"""
+		Works out how far rect can move along an axis before it collides with anything
+		:param rect: rect in level coordinates
+		:param axis: 'x' or 'y'
+		:param direction: 1 or -1
+		:param distance: the furthest the rect is meant to move, in pixels
+		:param kinds: the kinds of items that block the rect
+		:param exclude: an item that never blocks the rect
+		:return: the number of pixels the rect can move, at most distance
+		"""
+		# The area the rect passes through
+		if axis == 'x':
+			swept = pygame.Rect(rect.left - distance * (direction < 0), rect.top,
+			                    rect.width + distance, rect.height)
+		else:
+			swept = pygame.Rect(rect.left, rect.top - distance * (direction < 0),
+			                    rect.width, rect.height + distance)
+
+		free = distance
+		for item in self.query(swept, kinds, exclude):
+			item_rect = self.items[item][0]
+			if item_rect.colliderect(rect):
+				return 0
+
+			if axis == 'x' and direction > 0:
+				gap = item_rect.left - rect.right
+			elif axis == 'x':
+				gap = rect.left - item_rect.right
+			elif direction > 0:
+				gap = item_rect.top - rect.bottom
+			else:
+				gap = rect.top - item_rect.bottom
+
+			if gap < free:
+				free = gap
+		return free
+
+	def first(self, rect, kinds, exclude=None):
+		"""
+		Same as query but stops at the first colliding item
+		:return: The colliding item or None if nothing collides
+		"""
+		checked = 0
+		for cell in self._cells_for(rect):
+			for item in self.cells.get(cell, ()):
+				if item is exclude:
+					continue
+
+				checked += 1
+				item_rect, kind, _ = self.items[item]
+				if kind in kinds and item_rect.colliderect(rect):
+					profiler.collision_checks += checked
+					return item
+		profiler.collision_checks += checked
+		return None
+
+
+class StaticLayer:
+	"""
+	The blocks that never move (sensors, walls, doors and zones) drawn ahead of time onto
+	square chunks of the level, so that each frame only has to blit the chunks on the screen.
+	A chunk is drawn the first time it is on the screen and drawn again after a door on it
+	locks or unlocks. Chunks more than margin chunks away from the screen are thrown away, so
+	the chunks kept don't add up as the player goes through a big level
+	"""
+	draw_order = ('sensor', 'wall', 'door', 'no drag', 'no move')
+
+	def __init__(self, chunk_size=10 * tile_width, margin=1):
+		self.chunk_size = chunk_size
+		self.margin = margin  # How many chunks around the screen are kept after they go off it
+		self.chunks = dict()  # (column, row): Surface
+		self.screen_chunks = None  # (first column, last column, first row, last row) on the screen
+
+	def redraw(self, rect=None):
+		"""
+		Throws away the chunks so that they are drawn again the next time they are on the screen
+		:param rect: Only the chunks overlapping this rect, in level coordinates, are thrown away.
+		If it is None, every chunk is
+		:return:
+		"""
+		if rect is None:
+			self.chunks = dict()
+			self.screen_chunks = None
+			screen_updater.update_all = True
+		else:
+			screen_updater.mark(rect.move(math.floor(screen_shift.x), math.floor(screen_shift.y)))
+			for column in range(rect.left // self.chunk_size, (rect.right - 1) // self.chunk_size + 1):
+				for row in range(rect.top // self.chunk_size, (rect.bottom - 1) // self.chunk_size + 1):
+					self.chunks.pop((column, row), None)
+
+	def _draw_chunk(self, column, row):
+		chunk_rect = pygame.Rect(column * self.chunk_size, row * self.chunk_size,
+		                         self.chunk_size, self.chunk_size)
+		chunk = pygame.Surface(chunk_rect.size).convert()
+		chunk.fill(off_white)
+
+		blocks = level_grid.query(chunk_rect, self.draw_order)
+		blocks.sort(key=lambda block: self.draw_order.index(level_grid.items[block][1]))
+		# Unlocked doors aren't in level_grid since nothing collides with them
+		blocks += [door for door in doors[1] if door not in level_grid and door.rect.colliderect(chunk_rect)]
+
+		for block in blocks:
+			block.draw_onto(chunk, block.x - chunk_rect.x, block.y - chunk_rect.y)
+
+		return chunk
+
+	def draw(self):
+		# Floored so that neighbouring chunks always line up
+		shift_x = math.floor(screen_shift.x)
+		shift_y = math.floor(screen_shift.y)
+
+		first_column, last_column = -shift_x // self.chunk_size, (display_width - shift_x - 1) // self.chunk_size
+		first_row, last_row = -shift_y // self.chunk_size, (display_height - shift_y - 1) // self.chunk_size
+
+		screen_chunks = (first_column, last_column, first_row, last_row)
+		if screen_chunks != self.screen_chunks:
+			self.screen_chunks = screen_chunks
+			for column, row in list(self.chunks):
+				if not (first_column - self.margin <= column <= last_column + self.margin
+				        and first_row - self.margin <= row <= last_row + self.margin):
+					del self.chunks[(column, row)]
+
+		for column in range(first_column, last_column + 1):
+			for row in range(first_row, last_row + 1):
+				chunk = self.chunks.get((column, row))
+				if chunk is None:
+					chunk = self.chunks[(column, row)] = self._draw_chunk(column, row)
+				Display.blit(chunk, (column * self.chunk_size + shift_x, row * self.chunk_size + shift_y))
+
+
+class LevelRecord:
+	"""
+	One level from Levels.txt, already parsed. The numbers are already multiplied by tile_width
+	"""
+	def __init__(self, name, screen_shift, entries):
+		self.name = name
+		self.screen_shift = screen_shift  # [x, y]
+		self.entries = entries  # List of (type, block arguments, sign message or None)
+
+
+class LevelStore:
+	"""
+	Every level in a levels file, parsed once when the game starts so that starting, replaying
+	and restarting a level never has to read the file again. A store loaded from a level pack
+	only reads the pack's table of contents when the game starts, and each level is read
+	from the memory mapped pack when it is played, so a pack with thousands of levels doesn't
+	have to be read or kept in memory
+
+	The type of each entry is its prefix in the file: 'w', 'm', 'd' and 's' for walls, zones
+	and signs, and two letters ('gs', 'bb', 'eg' etc.) for goals, barrier stuff and enemies
+	"""
+	def __init__(self, file_name=None):
+		self.names = list()  # In the order they are in the file
+		self.area_numbers = list()
+		self.index = dict()  # name: position in self.names
+		self.records = dict()  # name: LevelRecord
+		self.pack = None  # The memory mapped level pack
+		self.source_hash = None  # The hash of the text file the level pack was compiled from
+		self.pack_entries = dict()  # name: (where the level starts in the pack, how many bytes it takes)
+
+		if file_name is not None:
+			self.read_text(file_name)
+
+	@classmethod
+	def from_pack(cls, file_name):
+		"""
+		Loads a level pack made by compile_level_pack instead of parsing the text file
+		:param file_name:
+		:return:
+		"""
+		store = cls()
+		with open(file_name, 'rb') as pack:
+			# Stays open after the file is closed
+			store.pack = mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ)
+
+		magic, version, level_count, store.source_hash = struct.unpack_from(level_pack_header, store.pack, 0)
+		if magic != level_pack_magic or version != level_pack_version:
+			raise ValueError('Not a level pack this version of the game can read: ' + file_name)
+
+		offset = struct.calcsize(level_pack_header)
+		for _ in range(level_count):
+			name, offset = unpack_string(store.pack, offset)
+			level_offset, level_size = struct.unpack_from(level_pack_toc_entry, store.pack, offset)
+			offset += struct.calcsize(level_pack_toc_entry)
+			if level_offset + level_size > len(store.pack):
+				raise ValueError('The level pack is cut short in ' + name + ': ' + file_name)
+
+			store.add_name(name)
+			store.pack_entries[name] = (level_offset, level_size)
+
+		return store
+
+	def read_text(self, file_name):
+		with open(file_name, 'r') as levels:
+			lines = [line.rstrip('\n') for line in levels]
+
+		line_num = 0
+		while line_num < len(lines):
+			if lines[line_num][:1] != 'A':
+				line_num += 1
+				continue
+
+			name = lines[line_num]
+			board_values = list()
+			line_num += 1
+			while line_num < len(lines) and lines[line_num] != '':
+				board_values.append(lines[line_num])
+				line_num += 1
+
+			self.add(self.parse_level(name, board_values))
+
+	def add(self, record):
+		self.add_name(record.name)
+		self.records[record.name] = record
+
+	def add_name(self, name):
+		self.index[name] = len(self.names)
+		self.names.append(name)
+
+		area_num = int(name.split()[0][1:])
+		if area_num not in self.area_numbers:
+			self.area_numbers.append(area_num)
+
+	def __contains__(self, name):
+		return name in self.index
+
+	def get(self, name):
+		record = self.records.get(name)
+		if record is None:
+			level_offset, level_size = self.pack_entries[name]
+			# Only the level's own bytes are read, so a broken level can't run into the next one
+			try:
+				record, level_end = unpack_level(self.pack[level_offset:level_offset + level_size], 0)
+			except (struct.error, UnicodeDecodeError, IndexError):
+				level_end = None
+			if level_end != level_size:
+				raise ValueError('The level pack has a broken level: ' + name)
+		return record
+
+	def next_name(self, name):
+		"""
+		:param name:
+		:return: The name of the level after this one in the file, or None if it is the last one
+		"""
+		position = self.index.get(name)
+		if position is None or position + 1 >= len(self.names):
+			return None
+		return self.names[position + 1]
+
+	@classmethod
+	def parse_level(cls, name, board_values):
+		to_shift_x, to_shift_y = board_values[0].split()
+		entries = [cls.parse_entry(data) for data in board_values[1:]]
+		return LevelRecord(name, [tile_width * float(to_shift_x), tile_width * float(to_shift_y)], entries)
+
+	@staticmethod
+	def parse_entry(data):
+		"""
+		:param data: One line of a level after the screen shift
+		:return: (type, block arguments, sign message or None)
+		"""
+		try:
+			block_args = [int(float(num) * tile_width) for num in data[1:].split(',')]
+		except ValueError:
+			split_data = data.split(',')
+			for i in range(len(split_data[0])):
+				if split_data[0][i].isdigit():
+					block_args = [int(float(num) * tile_width) for num in data[i:].split(',')]
+					break
+			else:
+				if data[0] == 's':
+					split_data = data.split('\\')
+					for i in range(len(split_data[1])):
+						if split_data[1][i].isdigit():
+							block_args = [int(float(num) * tile_width) for num in
+							              data[len(split_data[0]) + i + 1:].split(',')]
+							break
+				else:
+					raise Exception('Invalid Line in Levels')
+
+		if data[0] == 's':
+			return 's', block_args, data[1:].split('\\')[0]
+		elif data[0] in ('g', 'b', 'e'):
+			return data[:2], block_args, None
+		return data[0], block_args, None
+
+
+class LevelChunks:
+	"""
+	In chunked level mode, the walls and zones of a level are split into square chunks and only
+	the chunks near the screen are in level_grid, so collisions and drawing only ever look at
+	the part of the level around the player. Mobs outside of the chunks next to the screen
+	are taken out of mobs, so they aren't moved, but stay in level_grid where they were so that
+	nothing can walk through them and sensors still sense them. Chunks are loaded and unloaded
+	as the screen shift changes
+
+	Doors, sensors, goals and signs are always in level_grid. The sensors, signs and goals that
+	never move are kept by chunk too, and only the ones in the loaded chunks are looked at each
+	step, in near. A sensor in a chunk that isn't loaded can only be held down by a mob that
+	isn't moving, so whether it is held down is worked out once when its chunk is unloaded
+	"""
+	streamed_kinds = ('wall', 'no drag', 'no move')
+	near_kinds = ('sensor', 'sign', 'goal')
+
+	def __init__(self, chunk_size=20 * tile_width, margin=1):
+		self.chunk_size = chunk_size
+		self.margin = margin  # How many chunks around the screen mobs are moved in
+
+		self.blocks = dict()  # (column, row): list of (block, kind) overlapping the chunk
+		self.entities = dict()  # (column, row): list of (entity, kind) of the entities with their centre in the chunk
+		self.loaded_chunks = set()
+		self.loaded_blocks = set()  # (block, kind)
+		self.paged_out_mobs = list()
+		self.screen_chunks = None  # (first column, last column, first row, last row) on the screen
+		self.near = {kind: list() for kind in self.near_kinds}  # kind: the entities in the loaded chunks
+		self.far_pressed_sensors = set()  # Sensors outside of the loaded chunks that a mob is on
+
+	def load(self, blocks_by_kind, entities_by_kind):
+		"""
+		Splits a new level into chunks. None of them are loaded until update is called
+		:param blocks_by_kind: (kind, list of blocks) for each of streamed_kinds
+		:param entities_by_kind: (kind, list of entities) for each of near_kinds, without the mobs
+		:return:
+		"""
+		self.blocks = dict()
+		self.entities = dict()
+		self.loaded_chunks = set()
+		self.loaded_blocks = set()
+		self.paged_out_mobs = list()
+		self.screen_chunks = None
+		self.far_pressed_sensors = set()
+
+		for kind, blocks in blocks_by_kind:
+			for block in blocks:
+				for chunk in self._chunks_for(block.rect):
+					self.blocks.setdefault(chunk, list()).append((block, kind))
+
+		# Every sensor counts as near until the first chunks load, so that every sensor is checked then
+		self.near = {kind: list() for kind in self.near_kinds}
+		for kind, entities in entities_by_kind:
+			self.near[kind] = list(entities)
+			for entity in entities:
+				self.entities.setdefault(self._chunk_of(entity), list()).append((entity, kind))
+
+	def _chunks_for(self, rect, extra=0):
+		return {(column, row)
+		        for column in range(rect.left // self.chunk_size - extra,
+		                            (rect.right - 1) // self.chunk_size + extra + 1)
+		        for row in range(rect.top // self.chunk_size - extra,
+		                         (rect.bottom - 1) // self.chunk_size + extra + 1)}
+
+	def _chunk_of(self, mob):
+		return mob.rect.centerx // self.chunk_size, mob.rect.centery // self.chunk_size
+
+	def update(self):
+		"""
+		Loads the chunks that have come near the screen and unloads the ones that have gone away
+		:return:
+		"""
+		screen_rect = pygame.Rect(-math.floor(screen_shift.x), -math.floor(screen_shift.y),
+		                          display_width, display_height)
+		screen_chunks = (screen_rect.left // self.chunk_size, (screen_rect.right - 1) // self.chunk_size,
+		                 screen_rect.top // self.chunk_size, (screen_rect.bottom - 1) // self.chunk_size)
+		if screen_chunks == self.screen_chunks:
+			return
+		self.screen_chunks = screen_chunks
+
+		awake_chunks = self._chunks_for(screen_rect, self.margin)
+		# The walls are loaded a chunk further out so that no mob is ever next to a missing wall
+		loaded_chunks = self._chunks_for(screen_rect, self.margin + 1)
+
+		loaded_blocks = set()
+		for chunk in loaded_chunks:
+			loaded_blocks.update(self.blocks.get(chunk, ()))
+
+		for block, kind in loaded_blocks - self.loaded_blocks:
+			level_grid.insert(block, block.rect, kind)
+		for block, _ in self.loaded_blocks - loaded_blocks:
+			level_grid.remove(block)
+
+		for column, row in self.loaded_chunks - loaded_chunks:
+			static_layer.redraw(pygame.Rect(column * self.chunk_size, row * self.chunk_size,
+			                                self.chunk_size, self.chunk_size))
+
+		if mob_integrator is not None and loaded_blocks != self.loaded_blocks:
+			mob_integrator.invalidate()
+
+		self.loaded_chunks = loaded_chunks
+		self.loaded_blocks = loaded_blocks
+
+		for mob in mobs[:]:
+			if self._chunk_of(mob) not in awake_chunks:
+				mobs.remove(mob)
+				self.paged_out_mobs.append(mob)
+
+		for mob in self.paged_out_mobs[:]:
+			if mob not in level_grid:
+				self.paged_out_mobs.remove(mob)  # Crushed
+			elif self._chunk_of(mob) in awake_chunks:
+				self.paged_out_mobs.remove(mob)
+				mob.previous_x, mob.previous_y = mob.x, mob.y
+				mob.awake = True
+				mobs.append(mob)
+
+		near = {kind: list() for kind in self.near_kinds}
+		for chunk in sorted(loaded_chunks):
+			for entity, kind in self.entities.get(chunk, ()):
+				near[kind].append(entity)
+		# The goals that move are near when they are being moved
+		near['goal'] += [mob for mob in mobs if level_grid.items[mob][1] == 'goal']
+
+		near_sensors = set(near['sensor'])
+		for sensor in self.near['sensor']:
+			if sensor not in near_sensors and mob_on_sensor(sensor):
+				self.far_pressed_sensors.add(sensor)
+		self.far_pressed_sensors -= near_sensors
+		self.near = near
+
+
+class MobIntegrator:
+	"""
+	Makes every falling mob fall at once with NumPy instead of one at a time, for levels with
+	lots of mobs. The ground under each mob is found by checking all of them against arrays of
+	the walls, locked doors and no move zones in level_grid at once. Other enemies aren't in the
+	arrays since they move, so they are still found with level_grid
+
+	The arrays are made again after invalidate is called, when a level starts, a door locks or
+	unlocks or level_chunks loads or unloads blocks
+	"""
+	def __init__(self):
+		self.static_edges = None  # (lefts, tops, rights, bottoms) of everything in static_solids
+
+	def invalidate(self):
+		self.static_edges = None
+
+	def _static_geometry(self):
+		if self.static_edges is None:
+			rects = [rect for rect, kind, _ in level_grid.items.values() if kind in static_solids]
+			edges = numpy.array([(rect.left, rect.top, rect.right, rect.bottom) for rect in rects],
+			                    dtype=float).reshape(-1, 4)
+			self.static_edges = edges.T
+		return self.static_edges
+
+	def fall(self, falling_mobs):
+		"""
+		Does the same as mob_falling for each of the mobs
+		:param falling_mobs: Mobs that can fall and have a velocity
+		:return:
+		"""
+		if not falling_mobs:
+			return
+
+		t = physics_step  # t is time
+		a = 9.81  # a is acceleration
+
+		terminal_velocity = jump_velocity * -2
+
+		velocity = numpy.array([mob.velocity for mob in falling_mobs], dtype=float)
+		x = numpy.array([mob.x for mob in falling_mobs], dtype=float)
+		y = numpy.array([mob.y for mob in falling_mobs], dtype=float)
+		width = numpy.array([mob.width for mob in falling_mobs], dtype=float)
+		height = numpy.array([mob.height for mob in falling_mobs], dtype=float)
+
+		y += velocity * t + 0.5 * a * (t ** 2)  # Kinematic equations of motion
+		velocity = numpy.minimum(velocity + a * t, terminal_velocity)
+
+		# The rect of each mob one pixel below where it fell to, truncated the same way as pygame.Rect
+		left = numpy.trunc(x)
+		top = numpy.trunc(y) + 1
+		right = left + width
+		bottom = top + height
+
+		lefts, tops, rights, bottoms = self._static_geometry()
+		touching = ((left[:, None] < rights) & (right[:, None] > lefts)
+		            & (top[:, None] < bottoms) & (bottom[:, None] > tops))
+		# The top of the highest block under each mob, or infinity if there isn't one
+		ground = numpy.where(touching, tops, numpy.inf).min(axis=1, initial=numpy.inf)
+
+		for i, mob in enumerate(falling_mobs):
+			highest = ground[i]
+			enemies_below = level_grid.query(pygame.Rect(int(left[i]), int(top[i]), mob.width, mob.height),
+			                                 dynamic_solids, exclude=mob)
+			if enemies_below:
+				highest = min(highest, min(enemy.y for enemy in enemies_below))
+
+			if highest != numpy.inf:
+				# Lands on the highest of the blocks it is touching
+				mob.y = float(highest) - mob.height
+				mob.velocity = 0
+			else:
+				mob.y = float(y[i])
+				mob.velocity = float(velocity[i])
+
+
 class ScreenShift:
+	"""
+	How much the level is shifted by on the screen. The blocks and mobs are kept in
+	level coordinates and this is only added on when they are drawn
+	"""
 	def __init__(self):
 		self._amount = [0, 0]
 
@@ -675,18 +2046,7 @@ class ScreenShift:
 
 	@staticmethod
 	def check_collide(character):
-		for tile in walls + doors[0] + no_move_zone + enemies:
-			if type(tile).__name__ != 'Mob':
-				tile.update_rect()
-
-			if tile.rect.colliderect(character.rect):
-				return True
-		return False
-
-	@staticmethod
-	def update_tiles():
-		for tile in walls + doors[0] + no_move_zone + enemies:
-			tile.update_rect()
+		return level_grid.first(character.world_rect(), move_blockers) is not None
 
 	def after_shift_change(self, old_value, axis):
 		if self.check_collide(player):
@@ -707,8 +2067,6 @@ class ScreenShift:
 				self.amount = starting_screen_shift
 				self.error = True
 
-			self.update_tiles()
-
 		if self.check_collide(player.jump_detector):
 			if player.velocity > 1 or player.velocity < 0:
 				pygame.mixer.Sound.play(sounds['thump'])
@@ -775,6 +2133,13 @@ class Button:
 		                  size=self.font_size,
 		                  side='custom_center')
 
+		biggest_outline = max(self.outline, self.high_line)
+		screen_updater.drew(self, pygame.Rect(self.x - self.width / 2 + to_shift_x - biggest_outline,
+		                                      self.y - self.height / 2 + to_shift_y - biggest_outline,
+		                                      self.width + 2 * biggest_outline,
+		                                      self.height + 2 * biggest_outline),
+		                    (outline, tuple(colour)))
+
 	def set_button_settings(self):
 		colour = self.colour
 
@@ -788,8 +2153,8 @@ class Button:
 			greyed_out_colour = tuple(greyed_out_colour)
 			return self.outline, greyed_out_colour
 
-		if (self.x - self.width / 2 <= pygame.mouse.get_pos()[0] <= self.x + self.width / 2
-		    and self.y - self.height / 2 <= pygame.mouse.get_pos()[1] <= self.y + self.height / 2):
+		if (self.x - self.width / 2 <= input_source.mouse_position()[0] <= self.x + self.width / 2
+		    and self.y - self.height / 2 <= input_source.mouse_position()[1] <= self.y + self.height / 2):
 			self.highlight = True
 			if button_pressed['mouse_1']:
 				colour = self.click_colour
@@ -846,8 +2211,8 @@ class MenuButton(Button):
 			return self.outline, greyed_out_colour
 
 		if is_mouse_visible:
-			if (self.x - self.width / 2 <= pygame.mouse.get_pos()[0] <= self.x + self.width / 2
-			    and self.y - self.height / 2 <= pygame.mouse.get_pos()[1] <= self.y + self.height / 2):
+			if (self.x - self.width / 2 <= input_source.mouse_position()[0] <= self.x + self.width / 2
+			    and self.y - self.height / 2 <= input_source.mouse_position()[1] <= self.y + self.height / 2):
 				self.highlight = True
 				tracker_pos = self.intended_tracker_pos
 				if button_pressed['mouse_1']:
@@ -911,6 +2276,13 @@ class LevelSelectButton(Button):
 		                  size=self.font_size,
 		                  side='custom_center')
 
+		biggest_outline = max(self.outline, self.high_line)
+		screen_updater.drew(self, pygame.Rect(self.x + to_shift_x - biggest_outline,
+		                                      self.y + to_shift_y - biggest_outline,
+		                                      self.width + 2 * biggest_outline,
+		                                      self.height + 2 * biggest_outline),
+		                    (outline, tuple(colour), tuple(msg_colour)))
+
 	def set_button_settings(self):
 		colour = self.colour
 
@@ -932,8 +2304,8 @@ class LevelSelectButton(Button):
 
 			return self.outline, greyed_out_colour, greyed_out_msg_colour
 
-		if (self.x <= pygame.mouse.get_pos()[0] <= self.x + self.width
-		    and self.y <= pygame.mouse.get_pos()[1] <= self.y + self.height):
+		if (self.x <= input_source.mouse_position()[0] <= self.x + self.width
+		    and self.y <= input_source.mouse_position()[1] <= self.y + self.height):
 			self.highlight = True
 			if button_pressed['mouse_1']:
 				colour = self.click_colour
@@ -956,18 +2328,92 @@ class LevelSelectButton(Button):
 		return outline, colour, self.msg_colour
 
 
-def text_object(text, colour, size):
-	if size == 'small':
-		text_surface = small_font.render(text, True, colour)
-	elif size == 'medium':
-		text_surface = med_font.render(text, True, colour)
-	elif size == 'large':
-		text_surface = large_font.render(text, True, colour)
+def profiled(name):
+	"""
+	Makes profiler time a function while it is active
+	:param name: What the function is called on the overlay and in the log
+	:return: The decorator
+	"""
+	def decorator(function):
+		@functools.wraps(function)
+		def timed(*args, **kwargs):
+			if not profiler.active:
+				return function(*args, **kwargs)
+
+			profiler.start(name)
+			try:
+				return function(*args, **kwargs)
+			finally:
+				profiler.stop()
+		return timed
+	return decorator
+
+
+@functools.lru_cache(maxsize=text_cache_size)
+def rendered_text(text, colour, size):
+	"""
+	Text is only rendered the first time it is needed in each colour and size. The returned
+	surface is shared, so it must not be drawn on
+	:param text:
+	:param colour: Must be a tuple
+	:param size:
+	:return:
+	"""
+	if size in fonts.sources:
+		return fonts[size].render(text, True, colour)
 	else:
 		raise Exception('Incorrect size in def of text_object()')
+
+
+def text_object(text, colour, size):
+	text_surface = rendered_text(text, tuple(colour), size)
 	return text_surface, text_surface.get_rect()
 
 
+@functools.lru_cache(maxsize=text_cache_size)
+def wrap_text(msg, width, size):
+	"""
+	Splits a message into lines that are each narrower than the width. Lines are broken after
+	a space where possible and keep that space at their end, while a space that a line break
+	lands on is dropped. The longest part of the message that fits is found with a binary
+	search over the font's measurements, so nothing is rendered
+	:param msg:
+	:param width: The width every line must be narrower than
+	:param size: 'small', 'medium' or 'large'
+	:return: A tuple of the lines
+	"""
+	font = fonts[size]
+	lines = list()
+
+	while True:
+		# The longest start of the message that fits
+		shortest_too_long = len(msg) + 1
+		longest_fitting = 0
+		while shortest_too_long - longest_fitting > 1:
+			middle = (longest_fitting + shortest_too_long) // 2
+			if font.size(msg[:middle])[0] < width:
+				longest_fitting = middle
+			else:
+				shortest_too_long = middle
+
+		line = msg[:longest_fitting]
+		rest = msg[longest_fitting:]
+
+		if line and line[-1] != ' ' and rest:
+			if rest[0] == ' ':
+				rest = rest[1:]
+			elif ' ' in line:
+				# Don't break in the middle of a word
+				line = line[:line.rindex(' ') + 1]
+				rest = msg[len(line):]
+
+		lines.append(line)
+		if font.size(rest)[0] < width or not line:
+			lines.append(rest)
+			return tuple(lines)
+		msg = rest
+
+
 def message_to_screen(msg,
                       colour,
                       y_displace=0,
@@ -1027,6 +2473,7 @@ def message_to_screen(msg,
 		text_rect.center = (display_width / 2) + x_displace, \
 		                   (display_height / 2) + y_displace
 	Display.blit(text_surf, text_rect)
+	screen_updater.drew(('text', msg, tuple(colour), size, side, x_displace, y_displace), text_rect)
 
 	return text_rect
 
@@ -1081,8 +2528,8 @@ def shifting_animation(dragged=False):
 		else:
 			draw_scene()
 
-		pygame.display.update()
-		clock.tick(120)
+		screen_updater.update()
+		limit_frame_rate(120)
 	player.x = player.original_x
 	player.y = player.original_y
 	screen_shift.amount = [old_screen_shift[0] - difference[0], old_screen_shift[1] - difference[1]]
@@ -1093,74 +2540,66 @@ def shifting_animation(dragged=False):
 		screen_shift.error = False
 
 
-def is_block_in_between(blocks, detector, first_point, last_point):
+def path_hits_rect(start, end, width, height, rect):
 	"""
-	Checks to see if a line of detectors from one of the points to the other collides
-	with a wall
-	:param blocks: the blocks that are checked to see if they are in between
-	:param detector: detector used to check collision with block
-	:param first_point: first point detector starts from
-	:param last_point: last point detector ends at
+	Checks if a box moving in a straight line overlaps rect at any point along the way.
+	The rect is grown by the size of the box so that only the top left corner of the box
+	has to be followed, which makes it a line against rect check
+	:param start: top left corner of the box at the start
+	:param end: top left corner of the box at the end
+	:param width: width of the box
+	:param height: height of the box
+	:param rect: the rect being checked
 	:return:
 	"""
+	profiler.collision_checks += 1
+	t_enter = 0
+	t_exit = 1
+
+	for origin, to_move, low, high in ((start[0], end[0] - start[0], rect.left - width, rect.right),
+	                                   (start[1], end[1] - start[1], rect.top - height, rect.bottom)):
+		if to_move == 0:
+			if not low < origin < high:
+				return False
+		else:
+			# The fractions of the way along the line where it enters and leaves the rect on this axis
+			t_low = (low - origin) / to_move
+			t_high = (high - origin) / to_move
+			t_enter = max(t_enter, min(t_low, t_high))
+			t_exit = min(t_exit, max(t_low, t_high))
+			if t_enter >= t_exit:
+				return False
 
-	# first_point_2 = first_point_1[0] + detector.width, first_point_1[1] + detector.height
-	# last_point_2 = last_point_1[0] + detector.width, last_point_1[1] + detector.height
-
-	close_to_0 = 0.00001  # A value close to 0 to make sure that divisors
-	#  are not close to 0 to prevent dividing by zero
-
-	if abs(last_point[0] - first_point[0]) > close_to_0:
-
-		# Calculates the gradient
-		gradient = (last_point[1] - first_point[1]) / (last_point[0] - first_point[0])
-	else:
-		gradient = 9999  # An arbitrary large value for the gradient
-
-	c = last_point[1] - gradient * last_point[0]
-
-	# Makes sure that the axis with the largest difference is used to
-	# reduce the number of gaps between the detectors
-	if abs(last_point[0] - first_point[0]) > abs(last_point[1] - first_point[1]):
-		z1 = first_point[0]
-		z2 = last_point[0]
-
-		used_axis = 'x'
-	else:
-		z1 = first_point[1]
-		z2 = last_point[1]
-
-		used_axis = 'y'
-
-	# stride is how many pixels being skipped when generating collision detectors
-	stride = 20
-	if z1 > z2:
-		stride = -stride
+	return True
 
-	for z in range(int(z1), int(z2) + 1, stride):
-		if used_axis == 'x':
-			x = z
-			y = gradient * x + c
-		else:
-			y = z
-			if abs(gradient) > close_to_0:
-				x = (y - c) / gradient
-			else:
-				x = last_point[0]
 
-		detector.x = x
-		detector.y = y
+def is_block_in_between(kinds, detector, first_point, last_point, exclude=None):
+	"""
+	Checks to see if the detector moving from one of the points to the other collides
+	with a wall at any point along the way
+	:param kinds: the kinds of blocks that are checked to see if they are in between
+	:param detector: detector with the size of the thing being moved
+	:param first_point: first point detector starts from
+	:param last_point: last point detector ends at
+	:param exclude: a block that is ignored, usually the character being dragged
+	:return:
+	"""
+	start = first_point[0] - screen_shift.x, first_point[1] - screen_shift.y
+	end = last_point[0] - screen_shift.x, last_point[1] - screen_shift.y
 
-		# Uncomment this to see the collision detectors
-		# detector.draw()
-		# pygame.display.update()
+	# Only the blocks near the path are checked
+	near_path = pygame.Rect(math.floor(min(start[0], end[0])), math.floor(min(start[1], end[1])),
+	                        math.ceil(abs(end[0] - start[0])) + detector.width + 1,
+	                        math.ceil(abs(end[1] - start[1])) + detector.height + 1)
 
-		if detector.rect.collidelist(blocks) != -1:
+	for block in level_grid.query(near_path, kinds, exclude):
+		if path_hits_rect(start, end, detector.width, detector.height, level_grid.rect_of(block)):
 			return True
 
 	return False
 
 
+@profiled('character_dragging')
 def character_dragging(character, original_mouse_pos):
 	"""
 	Activates when the character is clicked on
@@ -1188,10 +2627,7 @@ def character_dragging(character, original_mouse_pos):
 			if character in enemies:
 				enemies.remove(character)
 				enemies.append(character)
-
-			enemies_except_current_character = enemies[:]
-			if character in enemies_except_current_character:
-				enemies_except_current_character.remove(character)
+				draw_order[character] = max(draw_order.values()) + 1
 
 			# first_collision is the location where the character following the mouse enters a wall
 			first_collision = None
@@ -1201,6 +2637,7 @@ def character_dragging(character, original_mouse_pos):
 
 			character.original_x = character.x
 			character.original_y = character.y
+			original_world_rect = character.world_rect()
 
 			original_x_with_shift = character.x_with_shift
 			original_y_with_shift = character.y_with_shift
@@ -1216,7 +2653,7 @@ def character_dragging(character, original_mouse_pos):
 				character.ghost.visible = False
 				receive_input()
 
-				mouse_pos = pygame.mouse.get_pos()
+				mouse_pos = input_source.mouse_position()
 
 				# Keeps track of the last position of the character
 				last_x, last_y = character.x_with_shift, character.y_with_shift
@@ -1226,8 +2663,9 @@ def character_dragging(character, original_mouse_pos):
 
 				destination_x, destination_y = character.x_with_shift, character.y_with_shift
 
-				if character.rect.collidelist(
-												walls + doors[0] + no_drag_zone + no_move_zone + enemies_except_current_character) != -1:  # True if collided
+				if level_grid.first(character.world_rect(),
+				                    drag_blockers,
+				                    exclude=character) is not None:  # True if collided
 					if not character.collision_detector.did_collide:
 						# See initialization of first_collision above
 						first_collision = character.x_with_shift, character.y_with_shift
@@ -1238,9 +2676,10 @@ def character_dragging(character, original_mouse_pos):
 					# character.collision_detector.y = character.y
 					# character.collision_detector.draw()
 
-					if is_block_in_between(no_move_zone + enemies_except_current_character,
+					if is_block_in_between(ghost_blockers,
 					                       character.collision_detector,
-					                       (character.x_with_shift, character.y_with_shift), (last_x, last_y)):
+					                       (character.x_with_shift, character.y_with_shift), (last_x, last_y),
+					                       exclude=character):
 						character.ghost.x, character.ghost.y = character.x_with_shift, character.y_with_shift
 						character.ghost.visible = True
 
@@ -1261,14 +2700,14 @@ def character_dragging(character, original_mouse_pos):
 				# 	# character.collision_detector.draw()
 				# character.draw()
 				if (first_collision and last_collision) is not None:
-					if is_block_in_between(walls + doors[0] + no_drag_zone, character.collision_detector, first_collision,
+					if is_block_in_between(drag_path_blockers, character.collision_detector, first_collision,
 					                       last_collision):
 						character.x_with_shift, character.y_with_shift = last_x, last_y
 						character.last_eligible_pos = [last_x, last_y]
 
 					first_collision = last_collision = None
 				if character.last_eligible_pos is not None:
-					if is_block_in_between(walls + doors[0] + no_drag_zone, character.collision_detector,
+					if is_block_in_between(drag_path_blockers, character.collision_detector,
 					                       (character.x_with_shift, character.y_with_shift),
 					                       character.last_eligible_pos):
 						character.x_with_shift = character.last_eligible_pos[0]
@@ -1293,8 +2732,9 @@ def character_dragging(character, original_mouse_pos):
 
 					character.collision_detector.x += to_move_x
 
-					if character.collision_detector.rect.collidelist(
-													walls + doors[0] + no_drag_zone + no_move_zone + enemies_except_current_character) == -1:
+					if level_grid.first(character.collision_detector.world_rect(),
+					                    drag_blockers,
+					                    exclude=character) is None:
 						make_change_x = True
 					# character.x = character.collision_detector.x
 
@@ -1311,8 +2751,9 @@ def character_dragging(character, original_mouse_pos):
 
 					character.collision_detector.y += to_move_y
 
-					if character.collision_detector.rect.collidelist(
-													walls + doors[0] + no_drag_zone + no_move_zone + enemies_except_current_character) == -1:
+					if level_grid.first(character.collision_detector.world_rect(),
+					                    drag_blockers,
+					                    exclude=character) is None:
 						make_change_y = True
 					# character.y_with_shift = character.collision_detector.y
 					if make_change_x:
@@ -1333,8 +2774,8 @@ def character_dragging(character, original_mouse_pos):
 				distance_from_start = (((original_x_with_shift - character.x_with_shift) ** 2) +
 				                       ((original_y_with_shift - character.y_with_shift) ** 2)) ** 0.5
 
-				pygame.display.update()
-				clock.tick(120)
+				screen_updater.update()
+				limit_frame_rate(120)
 
 			character.ghost.visible = False
 
@@ -1349,6 +2790,15 @@ def character_dragging(character, original_mouse_pos):
 			if drag_bar.total_time_to_recharge is None:
 				drag_bar.total_time_to_recharge = drag_ability.recharge_time_left
 
+			if isinstance(character, Mob):
+				character.awake = True
+				wake_mobs_near(original_world_rect.union(character.world_rect()))
+
+			# The drag happened all at once so there is nothing to draw in between
+			save_previous_state()
+
+			return True
+
 	elif (character.x_with_shift <= original_mouse_pos[0] < character.x_with_shift + character.width
 	      and character.y_with_shift <= original_mouse_pos[1] < character.y_with_shift + character.height
 	      and (not drag_ability.being_used)):
@@ -1363,23 +2813,47 @@ def character_dragging(character, original_mouse_pos):
 		character.tint = None
 
 
-def falling(to_fall=None):
+def furthest_shift(shift, to_shift, axis):
+	"""
+	Works out how far the screen can be shifted before the player hits a block in a single
+	query, instead of trying smaller and smaller shifts until one doesn't collide
+	:param shift: the current screen shift along the axis
+	:param to_shift: how much the screen is meant to be shifted by
+	:param axis: 'x' or 'y'
+	:return: the new screen shift
+	"""
+	target = shift + to_shift
+
+	# The player's rect in the level is offset by the floor of the screen shift (see Character.world_rect)
+	# and the level moves the opposite way to the player
+	pixels = math.floor(shift) - math.floor(target)
+	if pixels == 0:
+		return target
+
+	direction = 1 if pixels > 0 else -1
+	free = level_grid.sweep(player.world_rect(), axis, direction, abs(pixels),
+	                        move_blockers)
+	if free < abs(pixels):
+		target = math.floor(shift) - direction * free
+
+	return target
+
+
+@profiled('falling')
+def falling():
 	"""
 	Manages gravity and the jumping mechanic
-	:param to_fall: the screen is shifted by amount to_fall which is defined in the function if
-	if it is None. If the screen is shifted too much so that it collides with a block,
-	the screen_shift value will not change so then to_fall is adjusted slightly and then the
-	function is run again but with a different to_fall value
+	The screen is shifted by to_fall, or only as far as it can go before the player hits a block
 	:return:
 	"""
-	t = 0.1  # t is time
+	t = physics_step  # t is time
 	a = 9.81  # a is acceleration
 
 	terminal_velocity = jump_velocity * -2
 
 	if button_pressed['space']:
 		# player.jump_detector.update_rect(player)
-		if player.jump_detector.can_jump(walls + doors[0] + no_move_zone + enemies):
+		if player.jump_detector.can_jump(move_blockers):
 			pygame.mixer.Sound.play(sounds['jump'])
 			player.velocity = jump_velocity
 			if button_pressed['shift']:
@@ -1387,77 +2861,59 @@ def falling(to_fall=None):
 
 	# Falling
 	if player.velocity is not None:
-		if to_fall is None:
-			to_fall = player.velocity * t + 0.5 * a * (t ** 2)  # Kinematic equations of motion
+		to_fall = player.velocity * t + 0.5 * a * (t ** 2)  # Kinematic equations of motion
 		player.velocity += a * t
 		if player.velocity > terminal_velocity:
 			player.velocity = terminal_velocity
-		old_screen_shift_y = screen_shift.y  # Keeps track of the value to compare later
-		screen_shift.y -= to_fall
-
-		if (screen_shift.y == old_screen_shift_y) and abs(to_fall) > 0.05:  # Base case: to_fall is around 0
-			if to_fall < 0:
-				adjust = -1
-			elif to_fall > 0:
-				adjust = 1
-			else:
-				adjust = 0
 
-			try:
-				falling(to_fall=to_fall - adjust)
-			except RecursionError:
-				pass
+		new_screen_shift_y = furthest_shift(screen_shift.y, -to_fall, 'y')
+		if to_fall < 0:
+			# When the player hits their head on a block, every pixel they are stopped short by
+			# slows the jump down by another step of gravity
+			stopped_short_by = (screen_shift.y - to_fall) - new_screen_shift_y
+			if stopped_short_by > 0:
+				player.velocity += a * t * math.ceil(stopped_short_by)
+		screen_shift.y = new_screen_shift_y
 
 
-def walking(to_move=None):
+@profiled('walking')
+def walking():
 	"""
 	Left and Right movement
-	:param to_move: the screen is shifted by amount to_move which is defined in the function if
-	if it is None. If the screen is shifted too much so that it collides with a block,
-	the screen_shift value will not change so then to_move is adjusted slightly and then the
-	function is run again but with a different to_move value
+	The screen is shifted by to_move, or only as far as it can go before the player hits a block
 	:return:
 	"""
 	# Left and Right movement
 	# to_move keeps track of exactly how much to shift the screen before it is actually shifted
 
-	old_screen_shift_x = screen_shift.x
-
-	if to_move is None:
-		to_move = 0
-		if button_pressed['d']:
-			to_move = -3
-			if button_pressed['shift']:
-				to_move += 2
-		if button_pressed['a']:
-			to_move = 3
-			if button_pressed['shift']:
-				to_move -= 2
-
-	screen_shift.x += to_move
-
-	if (screen_shift.x == old_screen_shift_x) and abs(to_move) > 0.05:  # Base case: to_move is around 0
-		if to_move < 0:
-			adjust = -1
-		elif to_move > 0:
-			adjust = 1
-		else:
-			adjust = 0
-		walking(to_move=to_move - adjust)
-
-	enemy_index = player.rect.collidelist(enemies)
-	if enemy_index != -1:
-		if enemies[enemy_index].mask.overlap(player.mask,
-		                                     (int(player.x_with_shift - enemies[enemy_index].x_with_shift),
-		                                      int(player.y_with_shift - enemies[
-			                                      enemy_index].y_with_shift))) is not None:
-			if type(enemies[enemy_index]).__name__ != 'Boulder':
+	to_move = 0
+	if button_pressed['d']:
+		to_move = -3
+		if button_pressed['shift']:
+			to_move += 2
+	if button_pressed['a']:
+		to_move = 3
+		if button_pressed['shift']:
+			to_move -= 2
+
+	if to_move != 0:
+		screen_shift.x = furthest_shift(screen_shift.x, to_move, 'x')
+
+	for enemy in level_grid.query(player.world_rect(), enemy_kinds):
+		profiler.collision_checks += 1
+		if enemy.mask.overlap(player.mask,
+		                      (int(player.x_with_shift - enemy.x_with_shift),
+		                       int(player.y_with_shift - enemy.y_with_shift))) is not None:
+			if type(enemy).__name__ != 'Boulder':
 				game_over()
-			elif enemies[enemy_index].velocity != 0:
+				break
+			elif enemy.velocity != 0:
 				pygame.mixer.Sound.play(sounds['boulder crush'])
 				game_over()
+				break
 
 
+@profiled('player_movement')
 def player_movement():
 	"""
 	Manages the movement of the player
@@ -1467,7 +2923,7 @@ def player_movement():
 	global screen_shift
 	global player
 
-	mouse_pos = pygame.mouse.get_pos()
+	mouse_pos = input_source.mouse_position()
 
 	walking()
 
@@ -1480,46 +2936,56 @@ def player_movement():
 	# print(drag_ability.recharge_time_left)
 	# print(clock.get_time())
 	if drag_ability.recharge_time_left > 0:
-		drag_ability.recharge_time_left -= clock.get_time() * 0.001
+		drag_ability.recharge_time_left -= 1 / physics_rate
 	else:
 		drag_ability.recharge_time_left = 0
 		drag_bar.total_time_to_recharge = None
 
-	for sign in signs:
-		sign.update_rect()
-		if player.rect.colliderect(sign.rect):
+	signs_touching_player = level_grid.query(player.world_rect(), sign_kinds)
+	for sign in (level_chunks.near['sign'] if chunked_levels else signs):
+		if sign in signs_touching_player:
 			if button_pressed['w'] or button_pressed['up']:
 				sign.activated = True
 		else:
 			sign.activated = False
 
 
+@profiled('draw_scene')
 def draw_scene():
 	"""
 	This is where everything is drawn to the screen
 	:return:
 	"""
-	Display.fill(off_white)
-	for tile in sensors + walls + doors[0] + no_drag_zone + no_move_zone + goals + doors[1]:
-		if hasattr(tile, 'ghost'):
-			tile.ghost.draw()
+	if headless and not benchmark:
+		return  # Nobody would see it
 
+	Display.fill(off_white)
+	screen_updater.drew_scene(screen_shift.amount)
+	static_layer.draw()
+
+	# Only the things on the screen are looked at. The screen is made a tile bigger on each side
+	# since mobs are drawn part of the way between steps, away from their rects in level_grid.
+	# A ghost is only visible while its character is dragged, which keeps it under the mouse
+	on_screen = level_grid.query(pygame.Rect(-math.floor(screen_shift.x) - tile_width,
+	                                         -math.floor(screen_shift.y) - tile_width,
+	                                         display_width + 2 * tile_width,
+	                                         display_height + 2 * tile_width),
+	                             drawn_kinds)
+	on_screen.sort(key=draw_order.__getitem__)
+
+	for tile in on_screen:
+		if isinstance(tile, Character):
+			tile.draw_ghost()
 		tile.draw()
 
-	for sign in signs:
-		sign.draw()
-
-	for enemy in enemies:
-		enemy.ghost.draw()
-		enemy.draw()
-
-	player.ghost.draw()
+	player.draw_ghost()
 	player.draw()
 
 	drag_bar.draw()
 
-	for sign in signs:
-		if sign.activated:
+	# An activated sign is touching the player, so it is on the screen
+	for sign in on_screen:
+		if isinstance(sign, Sign) and sign.activated:
 			sign.sign_output()
 
 
@@ -1532,28 +2998,16 @@ def level_select():
 	global list_of_levels_left
 	done = False
 
-	completed_levels = list()  # List of levels that have been completed
+	completed_levels = read_completed_levels()  # List of levels that have been completed
 
-	with open('Saved Data.txt', 'r') as save_file:
-		for line in save_file:
-			line = line.rstrip('\n')
-			completed_levels.append(line)
-
-	with open('Levels.txt', 'r') as levels_file:
-		line = levels_file.readline()
-		if completed_levels:
-			while line.rstrip('\n') != completed_levels[-1]:
-				line = levels_file.readline()
-			while line != '':
-				line = levels_file.readline()
-				line = line.rstrip('\n')
-			line = levels_file.readline().rstrip('\n')
-			unlocked_levels = completed_levels[:]
-			if line != '':
-				unlocked_levels.append(line)  # List of levels that can be played
-		else:
-			unlocked_levels = list()
-			unlocked_levels.append('A1 L1')
+	if completed_levels:
+		unlocked_levels = completed_levels[:]  # List of levels that can be played
+		next_level = level_store.next_name(completed_levels[-1])
+		if next_level is not None:
+			unlocked_levels.append(next_level)
+	else:
+		unlocked_levels = list()
+		unlocked_levels.append('A1 L1')
 
 	# Without this variable, when holding mouse_1 before pressing pause and releasing it after,
 	# if one of the buttons is highlighted, and then mouse_1 is released, it will select it
@@ -1602,6 +3056,7 @@ def level_select():
 		done = receive_input('level_select')
 
 		Display.fill(off_white)
+		screen_updater.drew('level select', Display.get_rect())
 		msg_rect = message_to_screen('Area ' + str(area_num), black,
 		                             y_displace=0, x_displace=0,
 		                             size='large', side='top')
@@ -1627,9 +3082,9 @@ def level_select():
 			else:
 				star = images['grey star']
 
-			star = pygame.transform.scale(star,
-			                              (star_height, star_height))
+			star = scaled_image(star, (star_height, star_height))
 			Display.blit(star, star_box)
+			screen_updater.drew((button, 'star'), pygame.Rect(star_box, (star_height, star_height)), star)
 
 			if (not mouse_1_clicked_before_level_select) and (not button.greyed_out):
 				if button.output is not None:
@@ -1672,8 +3127,8 @@ def level_select():
 				                                                button_height)
 			arrow_button.output = None
 
-		pygame.display.update()
-		clock.tick(60)
+		screen_updater.update()
+		limit_frame_rate(60)
 
 
 def new_level_select_buttons(area_num,
@@ -1708,6 +3163,11 @@ def new_level_select_buttons(area_num,
 def level_complete(goal):
 	global current_level
 	global completion_buttons
+	global headless_outcome
+
+	if headless and not isinstance(input_source, InputPlayer):
+		headless_outcome = 'level complete'
+		return
 
 	done = False
 
@@ -1720,15 +3180,7 @@ def level_complete(goal):
 	button_width = 250
 	button_separation = 300
 
-	to_save = current_level + '\n'
-
-	with open('Saved Data.txt', 'r') as read_save:
-		for line in read_save:
-			if to_save == line:
-				to_save = ''
-
-	with open('Saved Data.txt', 'a') as save_file:
-		save_file.write(to_save)
+	save_completed_level(current_level)
 
 	n = Display.convert_alpha()
 	n.fill((*grey, 100))
@@ -1742,6 +3194,7 @@ def level_complete(goal):
 		draw_scene()
 
 		Display.blit(n, (0, 0))
+		screen_updater.drew('level complete', Display.get_rect())
 
 		if not completion_buttons:
 			completion_buttons = [Button('Replay Level', black, green,
@@ -1777,10 +3230,10 @@ def level_complete(goal):
 				print('Test')
 				done = True
 
-				current_index = list_of_levels.index(current_level) + 1
+				next_level = level_store.next_name(current_level)
 
-				if current_index < len(list_of_levels):
-					current_level = list_of_levels[current_index]
+				if next_level is not None:
+					current_level = next_level
 
 				button.output = None
 
@@ -1789,22 +3242,25 @@ def level_complete(goal):
 
 			button.output = None
 
-		pygame.display.update()
-		clock.tick(120)
+		screen_updater.update()
+		limit_frame_rate(120)
 
 
 def mob_killing(character):
+	"""
+	:param character:
+	:return: The enemy crushed by the character or None. It still has to be taken out of mobs
+	"""
 	if type(character).__name__ == 'Boulder':
 		if character.jump_detector.velocity != 0:
-			character.jump_detector.can_jump(walls + doors[0] + no_move_zone)
-			enemies_except_current_character = enemies[:]
-			if character in enemies_except_current_character:
-				enemies_except_current_character.remove(character)
-
-			death_index = character.jump_detector.rect.collidelist(enemies_except_current_character)
-			if death_index != -1:
+			crushed = level_grid.first(character.world_rect().move(0, 1), dynamic_solids, exclude=character)
+			if crushed is not None:
 				pygame.mixer.Sound.play(sounds['boulder crush'])
-				enemies.remove(enemies_except_current_character[death_index])
+				enemies.remove(crushed)
+				level_grid.remove(crushed)
+				wake_mobs_near(crushed.rect)
+				return crushed
+	return None
 
 
 def mob_falling(character, to_fall=None):
@@ -1817,15 +3273,11 @@ def mob_falling(character, to_fall=None):
 	function is run again but with a different to_fall value
 	:return:
 	"""
-	t = 0.1  # t is time
+	t = physics_step  # t is time
 	a = 9.81  # a is acceleration
 
 	terminal_velocity = jump_velocity * -2
 
-	enemies_except_current_character = enemies[:]
-	if character in enemies_except_current_character:
-		enemies_except_current_character.remove(character)
-
 	# Falling
 	if character.velocity is not None:
 		if to_fall is None:
@@ -1834,18 +3286,10 @@ def mob_falling(character, to_fall=None):
 		if character.velocity > terminal_velocity:
 			character.velocity = terminal_velocity
 		character.y_with_shift += to_fall
-		if character.jump_detector.can_jump(walls + doors[0] + no_move_zone + enemies_except_current_character):
-			character.y = (walls
-			               + doors[0]
-			               + no_move_zone
-			               + enemies_except_current_character
-			               )[
-				              character.jump_detector.rect.collidelist(walls
-				                                                       + doors[0]
-				                                                       + no_move_zone
-				                                                       + enemies_except_current_character
-				                                                       )
-			              ].y - character.height
+		ground = character.jump_detector.blocks_below(move_blockers, exclude=character)
+		if ground:
+			# Lands on the highest of the blocks it is touching
+			character.y = min(block.y for block in ground) - character.height
 
 			character.velocity = 0
 
@@ -1853,11 +3297,9 @@ def mob_falling(character, to_fall=None):
 def mob_walking(character):
 	if character.name == 'Guard':
 		character.x += character.to_move
-		enemies_except_current_character = enemies[:]
-		if character in enemies_except_current_character:
-			enemies_except_current_character.remove(character)
-		if ((character.rect.collidelist(walls + doors[0] + no_move_zone + enemies_except_current_character) != -1)
-		    or character.jump_detector.might_fall(walls + doors[0] + no_move_zone + enemies_except_current_character)):
+		if ((level_grid.first(level_grid.rect_of(character), move_blockers,
+		                      exclude=character) is not None)
+		    or character.jump_detector.might_fall(move_blockers, exclude=character)):
 			character.x -= character.to_move
 			character.to_move = -character.to_move
 
@@ -1867,22 +3309,167 @@ def mob_walking(character):
 			character.facing = 'right'
 
 
+def wake_mobs_near(rect):
+	"""
+	Wakes up the mobs in or touching a part of the level after something there changed
+	:param rect: In level coordinates
+	:return:
+	"""
+	for mob in level_grid.query(rect.inflate(2, 2), mob_kinds):
+		if isinstance(mob, Mob):
+			mob.awake = True
+
+
+@profiled('mob_movement')
 def mob_movement():
-	for entity in enemies + goals:
-		if type(entity).__name__ != 'Block':
+	crushed_mobs = None
+
+	if mob_integrator is not None:
+		# Every mob falls first, all at once
+		falling_mobs = [entity for entity in mobs
+		                if entity.awake and entity.can_fall and entity.velocity is not None]
+		rects_before = {entity: entity.rect.copy() for entity in falling_mobs}
+		velocities_before = {entity: entity.velocity for entity in falling_mobs}
+		mob_integrator.fall(falling_mobs)
+
+	for entity in mobs:
+		if entity not in level_grid:
+			continue  # Crushed by a boulder earlier in this step
+
+		if not entity.awake:
+			# Dragging is the only thing that can happen to an asleep mob by itself
+			if entity.can_drag:
+				character_dragging(entity, input_source.mouse_position())
+			continue
+
+		if mob_integrator is not None and entity in rects_before:
+			rect_before = rects_before[entity]
+			entity.jump_detector.velocity = velocities_before[entity]
+		else:
+			rect_before = entity.rect.copy()
+
 			entity.jump_detector.velocity = entity.velocity  # This is to test the boulder's velocity for enemy deaths
 			if entity.can_fall:
 				mob_falling(entity)
-			if entity.can_drag:
-				character_dragging(entity, pygame.mouse.get_pos())
-			if entity.can_move:
-				mob_walking(entity)
-			mob_killing(entity)
+		if entity.can_drag:
+			character_dragging(entity, input_source.mouse_position())
+		if entity.can_move:
+			mob_walking(entity)
+		crushed = mob_killing(entity)
+		if crushed is not None:
+			# Taken out of mobs after the loop so that the loop doesn't skip anything
+			if crushed_mobs is None:
+				crushed_mobs = list()
+			crushed_mobs.append(crushed)
+
+		if entity.rect != rect_before:
+			# Anything resting on it or next to it might have to move now
+			wake_mobs_near(rect_before.union(entity.rect))
+		elif entity.velocity == 0 and not (entity.can_move and entity.name == 'Guard'):
+			entity.awake = False
+
+	if crushed_mobs is not None:
+		for crushed in crushed_mobs:
+			if crushed in mobs:  # Not if level_chunks had paged it out
+				mobs.remove(crushed)
+
+
+def simulation_step():
+	"""
+	Moves the game forward by one step of 1 / physics_rate seconds
+	:return:
+	"""
+	save_previous_state()
+
+	# Only once a step, with the screen shift the last step ended with. The walls are loaded far
+	# enough around the screen for the frames drawn between steps, drags and menus
+	if chunked_levels:
+		level_chunks.update()
+
+	player_movement()
+
+	mob_movement()
+
+	door_status()
+
+
+def save_previous_state():
+	"""
+	Keeps track of where everything was before a simulation step so that frames drawn
+	between steps can be drawn part of the way between them
+	:return:
+	"""
+	global previous_screen_shift
+
+	previous_screen_shift = screen_shift.amount[:]
+	for entity in mobs:
+		entity.previous_x, entity.previous_y = entity.x, entity.y
+
+
+def draw_scene_between_steps(alpha):
+	"""
+	Draws the scene part of the way between the previous simulation step and the current one
+	:param alpha: How far between the steps, from 0 (the previous step) to 1 (the current step)
+	:return:
+	"""
+	current_screen_shift = screen_shift.amount[:]
+	screen_shift.hard_reset = [previous + (current - previous) * alpha
+	                           for previous, current in zip(previous_screen_shift, current_screen_shift)]
+
+	# The positions are changed without going through the setters so that
+	# the rects and level_grid stay where the mobs really are
+	moved_mobs = list()
+	for entity in mobs:
+		if (entity.previous_x, entity.previous_y) != (entity.x, entity.y):
+			moved_mobs.append((entity, entity.x, entity.y))
+			entity._x = entity.previous_x + (entity.x - entity.previous_x) * alpha
+			entity._y = entity.previous_y + (entity.y - entity.previous_y) * alpha
+
+	draw_scene()
+
+	screen_shift.hard_reset = current_screen_shift
+	for entity, x, y in moved_mobs:
+		entity._x = x
+		entity._y = y
+
+
+def goal_status():
+	"""
+	Checks if the player is trying to complete the level while standing at a goal
+	:return:
+	"""
+	goal_reached = level_grid.first(player.world_rect(), goal_kinds)
+
+	for goal in (level_chunks.near['goal'] if chunked_levels else goals):
+		if goal.tint is not None:
+			goal.tint = None
+
+	if goal_reached is not None:
+		if button_pressed['w'] and player.jump_detector.can_jump(goal_ground):
+			if level_grid.first(level_grid.rect_of(goal_reached), enemy_kinds) is None:
+				if type(goal_reached).__name__ not in {'Block', 'Mob'}:
+					return
+				elif type(goal_reached).__name__ == 'Mob':
+					if goal_reached.velocity != 0:
+						return
+				if type(goal_reached).__name__ == 'Mob':
+					level_complete(goal_reached)
+				else:
+					if not goal_reached.final:
+						level_complete(goal_reached)
+					else:
+						game_complete()
+			else:
+				goal_reached.tint = red
 
 
 def game_loop():
 	"""
 	The main loop of the game
+
+	The game is simulated physics_rate times a second no matter how many frames are drawn,
+	so a slow frame doesn't slow the game down. Each frame is drawn part of the way between
+	the last two simulation steps
 	:return:
 	"""
 	global game_exit
@@ -1890,75 +3477,238 @@ def game_loop():
 
 	game_exit = False
 
+	time_to_simulate = 0  # Time that has passed but hasn't been simulated yet, in seconds
+	clock.tick()
+
 	while not game_exit:
 		receive_input()
 
-		player_movement()
-
-		mob_movement()
+		time_to_simulate += min(clock.get_time() * 0.001, max_frame_time)
+		steps = 0
+		while time_to_simulate >= 1 / physics_rate:
+			steps += 1
+			time_to_simulate -= 1 / physics_rate
 
-		door_status()
+		# A replay plays as many steps as were played when it was recorded
+		for _ in range(input_source.steps_to_simulate(steps)):
+			simulation_step()
 
-		draw_scene()
+		draw_scene_between_steps(time_to_simulate * physics_rate)
 
-		goal_number = player.rect.collidelist(goals)
-
-		for goal in goals:
-			if goal.tint is not None:
-				goal.tint = None
-
-		if goal_number != -1:
-			if button_pressed['w'] and player.jump_detector.can_jump(walls + doors[0]):
-				if goals[goal_number].rect.collidelist(enemies) == -1:
-					if type(goals[goal_number]).__name__ not in {'Block', 'Mob'}:
-						continue
-					elif type(goals[goal_number]).__name__ == 'Mob':
-						if goals[goal_number].velocity != 0:
-							continue
-					if type(goals[goal_number]).__name__ == 'Mob':
-						level_complete(goals[goal_number])
-					else:
-						if not goals[goal_number].final:
-							level_complete(goals[goal_number])
-						else:
-							game_complete()
-				else:
-					goals[goal_number].tint = red
+		goal_status()
 
-		pygame.display.update()
-		clock.tick(120)
+		screen_updater.update()
+		limit_frame_rate(render_rate)
 
 	pygame.quit()
 	quit()
 
 
+def run_headless(level_name, frames, source=None):
+	"""
+	Plays a level in headless mode as fast as possible, one simulation step a frame. Each frame of
+	a drag is a frame too, and its input comes from source the same way, so a bot can drag
+	:param level_name: The level to play, e.g. 'A1 L1'
+	:param frames: The most frames to play for. After that every button is let go of, which
+	ends a drag
+	:param source: The InputSource the buttons pressed and the mouse position come from. If it is
+	None, nothing is pressed
+	:return: (headless_outcome, the number of frames played). The outcome is None if the level
+	didn't end in time
+	"""
+	global headless_outcome
+	global input_source
+
+	input_source = LimitedInput(source if source is not None else InputSource(), frames)
+
+	headless_outcome = None
+	generate_map_from_file([level_name])
+
+	while input_source.frames_left > 0 and headless_outcome is None:
+		receive_input()
+		simulation_step()
+		goal_status()
+		screen_updater.update()
+
+	return headless_outcome, frames - input_source.frames_left
+
+
+def run_benchmark(frames, json_file=None):
+	"""
+	Plays every level for the same number of frames with ScriptedInput and prints how long each
+	part of a frame took. Guards patrol on their own, so the levels with guards time them too
+
+	A frame is what the game draws between two updates of the screen: one simulation step and a
+	draw, or one frame of a drag. The parts are timed by profiler, including the profiled functions
+	they call, and 'drag' is the part of each frame spent in character_dragging
+	:param frames: How many frames to play each level for
+	:param json_file: Where to also write the results as JSON, so they can be compared between runs
+	:return: The results, in the same form as the JSON
+	"""
+	global input_source
+	global headless_outcome
+
+	input_source = ScriptedInput()
+	parts = {'player_movement': 'player_movement',
+	         'drag': 'character_dragging',
+	         'mob_movement': 'mob_movement',
+	         'door_status': 'door_status',
+	         'draw_scene': 'draw_scene'}  # What it is called in the results: the profiled function
+
+	results = {'frames': frames,
+	           'physics_rate': physics_rate,
+	           'options': {'dirty_rects': dirty_rect_rendering,
+	                       'chunked_levels': chunked_levels,
+	                       'numpy_physics': mob_integrator is not None},
+	           'levels': {}}
+	all_times = {name: [] for name in list(parts) + ['frame']}
+
+	for level_name in level_store.names:
+		restarts = 0
+
+		headless_outcome = None
+		generate_map_from_file([level_name])
+		input_source.frame = -1
+		profiler.recorded_frames = list()
+		profiler.skip_frame()
+
+		while len(profiler.recorded_frames) < frames:
+			receive_input()
+			simulation_step()
+			draw_scene()
+			goal_status()
+			screen_updater.update()
+
+			# The level is played again from the start if the script ends it
+			if headless_outcome is not None:
+				restarts += 1
+				headless_outcome = None
+				generate_map_from_file([level_name])
+				profiler.skip_frame()
+
+		times = {name: [total_times.get(function, 0) for _, total_times in profiler.recorded_frames[:frames]]
+		         for name, function in parts.items()}
+		times['frame'] = [frame_time for frame_time, _ in profiler.recorded_frames[:frames]]
+		profiler.recorded_frames = None
+
+		results['levels'][level_name] = {'restarts': restarts,
+		                                 'mobs': len(mobs),
+		                                 'times': timing_summary(times)}
+		for name in all_times:
+			all_times[name] += times[name]
+
+		print(level_name.ljust(8), ' '.join('{} {:.3f}/{:.3f}'.format(name, summary['p50_ms'], summary['p99_ms'])
+		                                    for name, summary in timing_summary(times).items()))
+
+	results['all levels'] = timing_summary(all_times)
+	print('All'.ljust(8), ' '.join('{} {:.3f}/{:.3f}'.format(name, summary['p50_ms'], summary['p99_ms'])
+	                               for name, summary in results['all levels'].items()))
+	print('(p50/p99 in ms)')
+
+	if json_file is not None:
+		with open(json_file, 'w') as output:
+			json.dump(results, output, indent=4)
+
+	return results
+
+
+def timing_summary(times):
+	"""
+	:param times: A dictionary of lists of times in seconds
+	:return: A dictionary of the p50, p99 and mean of each list in milliseconds
+	"""
+	summary = {}
+	for name, durations in times.items():
+		ordered = sorted(durations)
+		if not ordered:
+			continue
+		summary[name] = {'p50_ms': percentile(ordered, 0.5) * 1000,
+		                 'p99_ms': percentile(ordered, 0.99) * 1000,
+		                 'mean_ms': sum(ordered) / len(ordered) * 1000}
+	return summary
+
+
+def percentile(ordered, fraction):
+	"""
+	:param ordered: A sorted list
+	:param fraction: e.g. 0.99 for the 99th percentile
+	:return: The smallest value that at least that fraction of the list is no bigger than
+	"""
+	return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def limit_frame_rate(fps):
+	"""
+	Waits so that no more than fps frames are drawn a second, except in headless mode
+	:param fps:
+	:return:
+	"""
+	if not headless:
+		clock.tick(fps)
+
+
+def argument_value(name, default=None):
+	"""
+	:param name: A command line option that takes a value, e.g. '--level'
+	:param default: What is returned if the option isn't given
+	:return: The value after the option
+	"""
+	if name in sys.argv[:-1]:
+		return sys.argv[sys.argv.index(name) + 1]
+	return default
+
+
+def mob_on_sensor(sensor):
+	"""
+	:param sensor:
+	:return: True if a mob, not a goal that can't move, is on the sensor
+	"""
+	return any(type(character).__name__ != 'Block'
+	           for character in level_grid.query(level_grid.rect_of(sensor), mob_kinds))
+
+
+@profiled('door_status')
 def door_status():
 	global doors
-	sensed = False
-	for sensor in sensors:
-		for character in enemies + goals + [player]:
-			if type(character).__name__ != 'Block':
-				sensor.update_rect()
-				character.update_rect()
-				if sensor.rect.colliderect(character.rect):
-					if doors[0]:
-						doors[1] = doors[0][:]
-						for door in doors[1]:
-							door.texture = light_grey
-					doors[0] = []
-					sensed = True
-					break
-	if not sensed:
-		if doors[1]:
+	player_rect = player.world_rect()
+
+	# In chunked level mode only the sensors near the screen can change
+	if chunked_levels:
+		sensed = bool(level_chunks.far_pressed_sensors)
+		nearby_sensors = level_chunks.near['sensor']
+	else:
+		sensed = False
+		nearby_sensors = sensors
+	for sensor in nearby_sensors:
+		if sensed:
+			break
+		profiler.collision_checks += 1
+		sensed = level_grid.rect_of(sensor).colliderect(player_rect) or mob_on_sensor(sensor)
+
+	if sensed:
+		if doors[0]:
+			doors[1] = doors[0][:]
+			for door in doors[1]:
+				door.texture = light_grey
+				level_grid.remove(door)
+				static_layer.redraw(door.rect)
+				wake_mobs_near(door.rect)
+			if mob_integrator is not None:
+				mob_integrator.invalidate()
+		doors[0] = []
+	elif doors[1]:
+		# The doors are only locked again once, when nothing is on a sensor anymore
+		if not doors[0]:
 			doors[0] = doors[1][:]
-			for entity in enemies + goals:
-				entity.update_rect()
-			player.update_rect()
 			for door in doors[0]:
 				door.texture = grey
-				door.update_rect()
-				if door.rect.colliderect(player.rect):
-					game_over()
+				level_grid.insert(door, door.rect, 'door')
+				static_layer.redraw(door.rect)
+				wake_mobs_near(door.rect)
+			if mob_integrator is not None:
+				mob_integrator.invalidate()
+		if level_grid.first(player_rect, door_kinds) is not None:
+			game_over()
 				# for entity in enemies:
 				# 	if door.rect.colliderect(entity.rect):
 				# 			enemies.remove(entity)
@@ -1989,7 +3739,7 @@ def paused():
 	while (not done) and (not game_exit):
 		done = receive_input('paused')
 
-		if pygame.mouse.get_rel() != (0, 0):
+		if input_source.mouse_movement() != (0, 0):
 			pygame.mouse.set_visible(True)
 			is_mouse_visible = True
 
@@ -2019,6 +3769,7 @@ def paused():
 
 		draw_scene()
 		Display.blit(n, (0, 0))
+		screen_updater.drew('paused', Display.get_rect())
 
 		message_to_screen('PAUSED', black, y_displace=20, size='large', side='top')
 
@@ -2071,23 +3822,52 @@ def paused():
 		if not button_states.space[-1]:
 			space_pressed_before_pause = False
 
-		pygame.display.update()
-		clock.tick(60)
+		screen_updater.update()
+		limit_frame_rate(60)
 
 	pygame.mixer.music.unpause()
 
 
+@profiled('receive_input')
 def receive_input(menu=None):
 	"""
-	Keeps track of the buttons pressed by modifying the button_pressed dictionary
+	Keeps track of the buttons pressed by modifying the button_pressed dictionary, from wherever
+	input_source gets them
+	:param menu:
+	:return:
+	"""
+	global is_mouse_visible
+
+	done = input_source.poll(menu)
+
+	# Handled here instead of where the input is read so that replays open and close the same menus
+	if button_pressed['escape']:
+		if menu != ('paused' or 'level_select'):
+			paused()
+		else:
+			done = True
+
+	if menu is None:
+		pygame.mouse.set_visible(True)
+		is_mouse_visible = True
+
+	if button_states.o[0] and not button_states.o[1]:
+		profiler.toggle_overlay()
+
+	return done
+
+
+def read_sdl_input(menu=None):
+	"""
+	Reads the buttons pressed from SDL's events into the button_pressed dictionary
 	:param menu:
 	:return:
 	"""
 	global game_exit
 	global Display
-	global is_mouse_visible
 
 	done = False
+	button_pressed['escape'] = False
 
 	for event in pygame.event.get():
 		if event.type == pygame.QUIT:
@@ -2126,10 +3906,7 @@ def receive_input(menu=None):
 			if event.key == pygame.K_o:
 				button_pressed['o'] = True
 			if event.key == pygame.K_ESCAPE:
-				if menu != ('paused' or 'level_select'):
-					paused()
-				else:
-					done = True
+				button_pressed['escape'] = True
 
 		if event.type == pygame.KEYUP:
 			if event.key == pygame.K_w:
@@ -2173,10 +3950,6 @@ def receive_input(menu=None):
 			if event.button == 3:
 				button_pressed['mouse_2'] = False
 
-	if menu is None:
-		pygame.mouse.set_visible(True)
-		is_mouse_visible = True
-
 	button_states.update()
 
 	return done
@@ -2187,6 +3960,11 @@ def game_over(error=False):
 	global is_mouse_visible
 	global tracker_pos
 	global game_exit
+	global headless_outcome
+
+	if headless and not isinstance(input_source, InputPlayer):
+		headless_outcome = 'game over'
+		return
 
 	done = False
 	tracker_pos = None
@@ -2204,7 +3982,7 @@ def game_over(error=False):
 	while (not done) and (not game_exit):
 		done = receive_input('game_over')
 
-		if pygame.mouse.get_rel() != (0, 0):
+		if input_source.mouse_movement() != (0, 0):
 			pygame.mouse.set_visible(True)
 			is_mouse_visible = True
 
@@ -2234,6 +4012,7 @@ def game_over(error=False):
 
 		draw_scene()
 		Display.blit(n, (0, 0))
+		screen_updater.drew('game over', Display.get_rect())
 
 		if not error:
 			message_to_screen('GAME OVER', black, y_displace=20, size='large', side='top')
@@ -2280,8 +4059,8 @@ def game_over(error=False):
 		if not button_states.space[-1]:
 			space_pressed_before_game_over = False
 
-		pygame.display.update()
-		clock.tick(60)
+		screen_updater.update()
+		limit_frame_rate(60)
 
 
 	# WWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
@@ -2318,6 +4097,11 @@ def game_complete():
 	global is_mouse_visible
 	global tracker_pos
 	global game_exit
+	global headless_outcome
+
+	if headless and not isinstance(input_source, InputPlayer):
+		headless_outcome = 'game complete'
+		return
 
 	done = False
 
@@ -2328,12 +4112,13 @@ def game_complete():
 		done = receive_input('game_over')
 
 		Display.fill(off_white)
+		screen_updater.drew('game complete', Display.get_rect())
 
 		message_to_screen('CONGRATULATIONS!!!', black, y_displace=20, size='large', side='top')
 		message_to_screen('YOU FOUND THE ONE TRUE BAGEL!!!!!', black, y_displace=400, size='medium', side='top')
 
-		pygame.display.update()
-		clock.tick(60)
+		screen_updater.update()
+		limit_frame_rate(60)
 
 
 def generate_map_from_file(levels_list):
@@ -2344,9 +4129,11 @@ def generate_map_from_file(levels_list):
 	global no_move_zone
 	global goals
 	global enemies
+	global mobs
 	global signs
 	global doors
 	global sensors
+	global draw_order
 
 	if not isinstance(levels_list, list):
 		levels_list = [levels_list]
@@ -2360,78 +4147,72 @@ def generate_map_from_file(levels_list):
 	doors = [[], []]  # Index 0: locked doors, Index 1: unlocked doors
 	sensors = list()
 
-	tile_width = 50
-
-	board_values = []
-
-	with open('Levels.txt', 'r') as levels:
-		line = levels.readline()
-		while line[:-1] != levels_list[0] and line != '':
-			line = levels.readline()
-		while line != '':
-			line = levels.readline()
-			line = line.rstrip('\n')
-			board_values.append(line)
-
-	board_values = board_values[:-1]
-
-	for data in board_values[1:]:
-		try:
-			block_args = [int(float(num) * tile_width) for num in data[1:].split(',')]
-		except ValueError:
-			split_data = data.split(',')
-			for i in range(len(split_data[0])):
-				if split_data[0][i].isdigit():
-					block_args = [int(float(num) * tile_width) for num in data[i:].split(',')]
-					break
-			else:
-				if data[0] == 's':
-					split_data = data.split('\\')
-					for i in range(len(split_data[1])):
-						if split_data[1][i].isdigit():
-							block_args = [int(float(num) * tile_width) for num in
-							              data[len(split_data[0]) + i + 1:].split(',')]
-							break
-				else:
-					raise Exception('Invalid Line in Levels')
+	level = level_store.get(levels_list[0])
 
-		if data[0] == 'w':
+	for kind, block_args, msg in level.entries:
+		if kind == 'w':
 			walls.append(Block(*block_args, brown))
-		elif data[0] == 'm':
+		elif kind == 'm':
 			no_drag_zone.append(Block(*block_args, purple))
-		elif data[0] == 'd':
+		elif kind == 'd':
 			no_move_zone.append(Block(*block_args, blue))
-		elif data[0] == 's':
-			split_data = data[1:].split('\\')
-			signs.append(Sign(split_data[0], *block_args, tile_width, tile_width))
-		elif data[0] == 'g':
-			if data[1] == 's':
-				goals.append(Block(*block_args, tile_width, tile_width, images['stationary goal']))
-			elif data[1] == 'p':
-				goals.append(Mob(*block_args, tile_width, tile_width, images['portable goal'],
-				                 name='Portable Goal'))
-			elif data[1] == 'f':
-				goals.append(Block(*block_args, tile_width, tile_width, images['final goal']))
-				goals[-1].final = True
-		elif data[0] == 'b':
-			if data[1] == 'b':
-				doors[0].append(Block(*block_args, grey))
-			elif data[1] == 's':
-				sensors.append(Block(*block_args, tile_width, tile_width, images['sensor']))
-		elif data[0] == 'e':
-			if data[1] == 'b':
-				enemies.append(Boulder(*block_args, can_move=False,
-				                       name='Boulder', img=images['boulder']))
-			elif data[1] == 's':
-				enemies.append(Mob(*block_args, can_move=False, can_fall=False, can_drag=False,
-				                   name='Spikes', img=images['spikes']))
-			elif data[1] == 'g':
-				enemies.append(Mob(*block_args,
-				                   name='Guard', img=images['guard']))
-
-	to_shift_x, to_shift_y = board_values[0].split()
-
-	screen_shift.hard_reset = [tile_width * float(to_shift_x), tile_width * float(to_shift_y)]
+		elif kind == 's':
+			signs.append(Sign(msg, *block_args, tile_width, tile_width))
+		elif kind == 'gs':
+			goals.append(Block(*block_args, tile_width, tile_width, images['stationary goal']))
+		elif kind == 'gp':
+			goals.append(Mob(*block_args, tile_width, tile_width, images['portable goal'],
+			                 name='Portable Goal'))
+		elif kind == 'gf':
+			goals.append(Block(*block_args, tile_width, tile_width, images['final goal']))
+			goals[-1].final = True
+		elif kind == 'bb':
+			doors[0].append(Block(*block_args, grey))
+		elif kind == 'bs':
+			sensors.append(Block(*block_args, tile_width, tile_width, images['sensor']))
+		elif kind == 'eb':
+			enemies.append(Boulder(*block_args, can_move=False,
+			                       name='Boulder', img=images['boulder']))
+		elif kind == 'es':
+			enemies.append(Mob(*block_args, can_move=False, can_fall=False, can_drag=False,
+			                   name='Spikes', img=images['spikes']))
+		elif kind == 'eg':
+			enemies.append(Mob(*block_args,
+			                   name='Guard', img=images['guard']))
+
+	# Everything that moves by itself, in the order it is moved in
+	mobs = [entity for entity in enemies + goals if isinstance(entity, Mob)]
+
+	draw_order = {entity: position for position, entity in enumerate(goals + signs + enemies)}
+
+	level_grid.clear()
+	for kind, blocks in (('wall', walls),
+	                     ('door', doors[0]),
+	                     ('no drag', no_drag_zone),
+	                     ('no move', no_move_zone),
+	                     ('sensor', sensors),
+	                     ('sign', signs),
+	                     ('goal', goals),
+	                     ('enemy', enemies)):
+		if chunked_levels and kind in LevelChunks.streamed_kinds:
+			continue  # Loaded by level_chunks when they are near the screen
+		for block in blocks:
+			level_grid.insert(block, block.rect, kind)
+
+	static_layer.redraw()
+	if mob_integrator is not None:
+		mob_integrator.invalidate()
+
+	screen_shift.hard_reset = level.screen_shift[:]
+
+	if chunked_levels:
+		level_chunks.load((('wall', walls),
+		                   ('no drag', no_drag_zone),
+		                   ('no move', no_move_zone)),
+		                  (('sensor', sensors),
+		                   ('sign', signs),
+		                   ('goal', [goal for goal in goals if not isinstance(goal, Mob)])))
+		level_chunks.update()
 
 	starting_screen_shift = [screen_shift.x, screen_shift.y]
 
@@ -2440,6 +4221,209 @@ def generate_map_from_file(levels_list):
 	player.velocity = 0
 	drag_ability.recharge_time_left = 0
 
+	save_previous_state()
+
+
+def pack_string(string):
+	encoded = string.encode('utf-8')
+	return struct.pack('<H', len(encoded)) + encoded
+
+
+def unpack_string(data, offset):
+	length, = struct.unpack_from('<H', data, offset)
+	offset += 2
+	return bytes(data[offset:offset + length]).decode('utf-8'), offset + length
+
+
+def pack_level(record):
+	"""
+	Turns a level into bytes for a level pack. The level is stored as its name, its screen shift,
+	a table of the sign messages and then runs of entries of the same type next to each other
+	in the file. Each run is packed as one array of ints with the block arguments followed by the
+	position of the entry's message in the table (-1 for no message)
+	:param record: A LevelRecord
+	:return:
+	"""
+	strings = list()
+	string_positions = dict()
+	runs = list()  # [type, number of block arguments, ints of every entry]
+
+	for kind, block_args, msg in record.entries:
+		if msg is None:
+			string_position = -1
+		else:
+			if msg not in string_positions:
+				string_positions[msg] = len(strings)
+				strings.append(msg)
+			string_position = string_positions[msg]
+
+		if not runs or runs[-1][0] != kind or runs[-1][1] != len(block_args):
+			runs.append([kind, len(block_args), list()])
+		runs[-1][2] += list(block_args) + [string_position]
+
+	parts = [pack_string(record.name),
+	         struct.pack('<2d', *record.screen_shift),
+	         struct.pack('<H', len(strings))]
+	parts += [pack_string(string) for string in strings]
+	parts.append(struct.pack('<H', len(runs)))
+
+	for kind, arg_count, ints in runs:
+		entry_count = len(ints) // (arg_count + 1)
+		parts.append(struct.pack('<2sBI', kind.encode('ascii'), arg_count, entry_count))
+		parts.append(struct.pack('<%di' % len(ints), *ints))
+
+	return b''.join(parts)
+
+
+def unpack_level(data, offset):
+	"""
+	Reads a level that was packed by pack_level
+	:param data: The bytes of the level pack
+	:param offset: Where the level starts in data
+	:return: (LevelRecord, where the level ends in data)
+	"""
+	name, offset = unpack_string(data, offset)
+	screen_shift = list(struct.unpack_from('<2d', data, offset))
+	offset += 16
+
+	string_count, = struct.unpack_from('<H', data, offset)
+	offset += 2
+	strings = list()
+	for _ in range(string_count):
+		string, offset = unpack_string(data, offset)
+		strings.append(string)
+
+	run_count, = struct.unpack_from('<H', data, offset)
+	offset += 2
+	entries = list()
+	for _ in range(run_count):
+		kind, arg_count, entry_count = struct.unpack_from('<2sBI', data, offset)
+		offset += struct.calcsize('<2sBI')
+		kind = kind.rstrip(b'\0').decode('ascii')
+
+		int_count = entry_count * (arg_count + 1)
+		ints = struct.unpack_from('<%di' % int_count, data, offset)
+		offset += 4 * int_count
+
+		for start in range(0, int_count, arg_count + 1):
+			string_position = ints[start + arg_count]
+			msg = strings[string_position] if string_position >= 0 else None
+			entries.append((kind, list(ints[start:start + arg_count]), msg))
+
+	return LevelRecord(name, screen_shift, entries), offset
+
+
+def text_file_hash(file_name):
+	"""
+	:param file_name:
+	:return: The SHA-256 of the file, which a level pack keeps to know if it was compiled from it
+	"""
+	with open(file_name, 'rb') as text_file:
+		return hashlib.sha256(text_file.read()).digest()
+
+
+def compile_level_pack(level_store, file_name='Levels.pack', source_hash=bytes(32)):
+	"""
+	Writes every level in the store to a level pack. Levels.txt is still where levels are made,
+	the pack is only so that they load faster
+
+	The pack starts with a header and a table of contents with the name of every level and
+	where it is in the pack, followed by the levels packed by pack_level
+	:param level_store:
+	:param file_name:
+	:param source_hash: The text_file_hash of the file the levels were read from
+	:return:
+	"""
+	toc_entry_size = struct.calcsize(level_pack_toc_entry)
+	toc_size = sum(len(pack_string(name)) + toc_entry_size for name in level_store.names)
+
+	with open(file_name, 'wb') as pack:
+		# The levels are written first, after space for the header and table of contents
+		level_positions = list()
+		offset = struct.calcsize(level_pack_header) + toc_size
+		pack.seek(offset)
+		for name in level_store.names:
+			packed_level = pack_level(level_store.get(name))
+			pack.write(packed_level)
+			level_positions.append((offset, len(packed_level)))
+			offset += len(packed_level)
+
+		pack.seek(0)
+		pack.write(struct.pack(level_pack_header, level_pack_magic, level_pack_version, len(level_store.names),
+		                       source_hash))
+		for name, (level_offset, level_size) in zip(level_store.names, level_positions):
+			pack.write(pack_string(name))
+			pack.write(struct.pack(level_pack_toc_entry, level_offset, level_size))
+
+
+def load_level_store(text_file='Levels.txt', pack_file='Levels.pack'):
+	"""
+	Loads the levels from the level pack if it was compiled from the text file as it is now,
+	otherwise from the text file. Running the game with --compile-levels writes the pack first.
+	Running it with --level-pack PATH plays the levels in that pack instead, such as a community
+	pack that doesn't come with its text file
+	:param text_file:
+	:param pack_file:
+	:return:
+	"""
+	if argument_value('--level-pack') is not None:
+		return LevelStore.from_pack(argument_value('--level-pack'))
+
+	source_hash = text_file_hash(text_file)
+
+	if '--compile-levels' in sys.argv:
+		store = LevelStore(text_file)
+		compile_level_pack(store, pack_file, source_hash)
+		return store
+
+	if os.path.exists(pack_file):
+		try:
+			store = LevelStore.from_pack(pack_file)
+		except (struct.error, ValueError, UnicodeDecodeError, OSError) as error:
+			print('Error in def of load_level_store()')
+			print(error)
+		else:
+			if store.source_hash == source_hash:
+				return store
+			store.pack.close()
+			print(pack_file, 'was compiled from a different', text_file + ', so it is ignored.',
+			      'Run the game with --compile-levels to compile it again')
+
+	return LevelStore(text_file)
+
+
+def read_completed_levels():
+	"""
+	:return: The levels that have been completed, in the order they were first completed
+	"""
+	if isinstance(input_source, InputPlayer):
+		return input_source.completed_levels[:]
+
+	completed_levels = list()
+	with open('Saved Data.txt', 'r') as save_file:
+		for line in save_file:
+			completed_levels.append(line.rstrip('\n'))
+	return completed_levels
+
+
+def save_completed_level(level_name):
+	"""
+	Adds a level to Saved Data.txt if it isn't there already. A replay only pretends to, so that
+	playing it doesn't change the save data
+	:param level_name:
+	:return:
+	"""
+	if isinstance(input_source, InputPlayer):
+		if level_name not in input_source.completed_levels:
+			input_source.completed_levels.append(level_name)
+		return
+
+	if level_name in read_completed_levels():
+		return
+
+	with open('Saved Data.txt', 'a') as save_file:
+		save_file.write(level_name + '\n')
+
 
 def get_levels(file):
 	level_names = []
@@ -2463,18 +4447,31 @@ no_drag_zone = list()
 no_move_zone = list()
 goals = list()
 enemies = list()
+mobs = list()
 signs = list()
 doors = [[], []]
 sensors = list()
+draw_order = dict()  # goal, sign or enemy: when it is drawn, the lowest first. Goals, then signs, then enemies
 
 screen_shift = ScreenShift()
+screen_updater = ScreenUpdater(dirty_rect_rendering)
+profiler = Profiler(argument_value('--profile-log'))
+level_grid = SpatialGrid()
+static_layer = StaticLayer()
+level_chunks = LevelChunks()
+
+if numpy_physics and numpy is None:
+	print('NumPy is not installed, so --numpy-physics is ignored')
+mob_integrator = MobIntegrator() if numpy_physics and numpy is not None else None
+level_store = load_level_store('Levels.txt', 'Levels.pack')
+startup_mark('levels')
 
 player = Character()
 
 drag_ability = Ability()
 drag_bar = CoolDownBar()
 
-list_of_levels, all_area_numbers = get_levels('Levels.txt')
+list_of_levels, all_area_numbers = level_store.names[:], level_store.area_numbers[:]
 
 levels_in_save_file, save_area_numbers = get_levels('Saved Data.txt')
 
@@ -2490,9 +4487,17 @@ if not list_of_levels_left:
 current_level = None
 
 generate_map_from_file(list_of_levels_left)
+startup_mark('map')
 
 button_states = InputButtonStates()
 
+if argument_value('--replay') is not None:
+	input_source = InputPlayer(argument_value('--replay'))
+elif argument_value('--record') is not None:
+	input_source = InputRecorder(argument_value('--record'))
+else:
+	input_source = InputSource()
+
 # Buttons
 
 paused_buttons = list()
@@ -2500,5 +4505,13 @@ completion_buttons = list()
 level_select_buttons = list()
 game_over_buttons = list()
 
-level_select()
-game_loop()
+if __name__ == '__main__':
+	if benchmark:
+		run_benchmark(int(argument_value('--frames', 10 * physics_rate)), argument_value('--json'))
+	elif headless and not isinstance(input_source, InputPlayer):
+		level_to_play = argument_value('--level', current_level)
+		frames_to_play = int(argument_value('--frames', 60 * physics_rate))
+		print(level_to_play, *run_headless(level_to_play, frames_to_play))
+	else:
+		level_select()
+		game_loop()